@@ -1,3 +1,12 @@
 #!/bin/bash
 
+# use the item name cache (the iteminfo table) when there is a DB to look in
+if [ -n "$DB_FILE" ]; then
+    NAME="$(sqlite3 "$DB_FILE" "SELECT name FROM iteminfo WHERE item_id = $1 AND name IS NOT NULL" 2>/dev/null)"
+    if [ -n "$NAME" ]; then
+        echo "$NAME"
+        exit 0
+    fi
+fi
+
 wget -qO- "http://www.wowhead.com/item=$1" | grep '</title>' | sed -r 's/.*>(.*) - Item .*/\1/'
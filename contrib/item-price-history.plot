@@ -13,7 +13,8 @@ set palette maxcolors 100
 set palette defined (0 "red", 99 "blue")
 set cblabel 'Hours Active'
 
-plot "< sed \"s/ITEM_ID/$ITEM_ID/\" contrib/item-price-history.sql | sqlite3 $DB_FILE" \
+# extra options for item-price-history.py (e.g. --days 90 --lttb 2000) go in $HISTORY_OPTS
+plot "< python2 ./item-price-history.py $HISTORY_OPTS sqlite:///$DB_FILE $ITEM_ID" \
     using 2:1:(($3 * 2) ** 0.5):4 \
     with points pt 7 ps variable lc palette \
     notitle
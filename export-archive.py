@@ -0,0 +1,37 @@
+#!/usr/bin/env python2
+
+import datetime
+import optparse
+
+from wowah import PARTITIONS, Auction, ColumnarArchive, db_connect, logger
+
+def parse_month(value):
+    return datetime.datetime.strptime(value, '%Y-%m')
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] DB_URL ARCHIVE_PATH')
+    parser.add_option('-s', '--start', default=None,
+        help='first month to export (YYYY-MM), defaults to the oldest auction')
+    parser.add_option('-e', '--end', default=None,
+        help='last month to export (YYYY-MM), defaults to the month of the newest row')
+    parser.add_option('-t', '--table', action='append', default=None,
+        choices=sorted(ColumnarArchive.TABLES.keys()))
+
+    opts, args = parser.parse_args()
+    db_url, archive_path = args
+
+    db_connect(db_url)
+    archive = ColumnarArchive(archive_path)
+
+    if opts.start is None:
+        start = Auction.select(Auction.started_at).order_by(Auction.started_at.asc()).scalar(convert=True)
+        # archived months are older than anything left in the auction table
+        start = (PARTITIONS.months() or [start])[0]
+        if start is None:
+            logger.info('Nothing to export')
+            raise SystemExit(0)
+    else:
+        start = parse_month(opts.start)
+    end = None if opts.end is None else parse_month(opts.end)
+    for table in opts.table or sorted(ColumnarArchive.TABLES.keys()):
+        archive.export(table, start, end)
@@ -3,119 +3,237 @@
 from __future__ import division
 
 import sys
-import json
 import datetime
 import math
-import subprocess
+import collections
+import multiprocessing
+import optparse
 
-from wowah import Auction, db_connect
+import numpy
+
+from wowah import ItemStats, ParsedFile, PriceSketch, ItemNameCache, PARTITIONS, db_connect
 
-DB = db_connect(sys.argv[1])
 GOLD_QUOTIENT = 10000
 
-LOOK_BACK_DAYS  = int(sys.argv[2])
 PCT_LARGE       = 0.75
 PCT_SMALL       = 0.25
 PCT_HIGH        = 0.90
 PCT_LOW         = 0.10
 
-STMT_SAMPLE_COUNT = """
-SELECT DISTINCT
-        started_at
-    FROM auction
-    WHERE
-        started_at >= ?
-;
-"""
 STMT_QUANTITY_STATS = """
-SELECT DISTINCT
+SELECT
         item_id
-        , max(quantity)
-        , count(*)
-        , sum(quantity)
-        , sum(buyout)
-    FROM auction
+        , max(buyout_quantity_max)
+        , sum(buyout_count)
+        , sum(buyout_quantity_sum)
+        , sum(buyout_sum)
+    FROM itemstats
     WHERE
-        started_at >= ?
-        AND buyout IS NOT NULL
+        period = 'hour'
+        AND period_start >= ?
+        AND buyout_count > 0
     GROUP BY item_id
 ;
 """
-STMT_PERCENTILE_STATS = """
+STMT_BUYOUTS = """
 SELECT
-        (CAST(buyout AS float) / quantity) / {gold_q:d} AS buyout_ppq
-    FROM auction
+        item_id
+        , quantity
+        , buyout
+    FROM {auction}
     WHERE
         started_at >= ?
-        AND item_id = ?
         AND buyout IS NOT NULL
-        AND quantity {q_cmp} ?
-    ORDER BY buyout_ppq
-    LIMIT 1
-    OFFSET CAST(((
-        SELECT
-                count(*)
-            FROM auction
-            WHERE
-                started_at >= ?
-                AND item_id = ?
-                AND buyout IS NOT NULL
-                AND quantity {q_cmp} ?
-        ) * ?) AS int)
+    ORDER BY item_id
 ;
 """
+FETCH_SIZE = 10000
 
-def get_item_name(item_id):
-    return subprocess.check_output(['./contrib/get-item-name.sh', str(item_id)]).strip()
-
-START_TIME = datetime.datetime.utcnow() - datetime.timedelta(days=LOOK_BACK_DAYS)
-SAMPLE_COUNT = len(Auction.select(Auction.started_at).distinct().where(Auction.started_at >= START_TIME))
-for item_id, mss, avol, qvol, tbo in DB.execute_sql(STMT_QUANTITY_STATS, params=(START_TIME,)):
-    if      mss == 1 \
+def is_candidate(mss, avol, sample_count):
+    return not (mss == 1 \
             or mss > 50 \
             or mss % 5 != 0 \
-            or avol < SAMPLE_COUNT * 2:
-        # this is not an item we care about
-        continue
+            or avol < sample_count * 2)
 
+def percentile(values, pct):
+    # same row as ORDER BY ... LIMIT 1 OFFSET CAST(count(*) * pct AS int)
+    idx = int(len(values) * pct)
+    if idx >= len(values):
+        raise ValueError('No values to take a percentile of')
+    return numpy.partition(values, idx)[idx]
+
+def score_item(item_id, mss, avol, qvol, tbo, sample_count, large_pct, small_pct):
+    """Compute the scores for one item.
+
+    ``large_pct`` and ``small_pct`` return the given percentile of the buyout
+    per item (in gold) of the large and small stack size buckets, raising
+    ValueError if the bucket is empty. Returns None for items that can not
+    be scored.
+    """
     try:
-        large_high = DB.execute_sql(STMT_PERCENTILE_STATS.format(q_cmp='>', gold_q=GOLD_QUOTIENT),
-            (START_TIME, item_id, int(mss * PCT_LARGE),
-            START_TIME, item_id, int(mss * PCT_LARGE), PCT_HIGH)).fetchall()[0][0]
-        large_low = DB.execute_sql(STMT_PERCENTILE_STATS.format(q_cmp='>', gold_q=GOLD_QUOTIENT),
-            (START_TIME, item_id, int(mss * PCT_LARGE),
-            START_TIME, item_id, int(mss * PCT_LARGE), PCT_LOW)).fetchall()[0][0]
+        large_high = large_pct(PCT_HIGH)
+        large_low = large_pct(PCT_LOW)
         large_diff = large_high - large_low
         large_avg = large_high + large_low / 2
 
-        small_high = DB.execute_sql(STMT_PERCENTILE_STATS.format(q_cmp='<', gold_q=GOLD_QUOTIENT),
-            (START_TIME, item_id, int(mss * PCT_SMALL),
-            START_TIME, item_id, int(mss * PCT_SMALL), PCT_HIGH)).fetchall()[0][0]
-        small_low = DB.execute_sql(STMT_PERCENTILE_STATS.format(q_cmp='<', gold_q=GOLD_QUOTIENT),
-            (START_TIME, item_id, int(mss * PCT_SMALL),
-            START_TIME, item_id, int(mss * PCT_SMALL), PCT_LOW)).fetchall()[0][0]
+        small_high = small_pct(PCT_HIGH)
+        small_low = small_pct(PCT_LOW)
         small_diff = small_high - small_low
         small_avg = small_high + small_low / 2
 
         avg_bo_ppq = (tbo / GOLD_QUOTIENT) / qvol
         bucket_diff = abs(large_avg - small_avg)
         bucket_avg = (small_avg + large_avg) / 2
-    except IndexError as err:
-        continue
+    except ValueError:
+        # no auctions in one of the stack size buckets
+        return None
+
+    if bucket_diff <= 0 or bucket_avg <= 0 or avg_bo_ppq <= 0:
+        # no spread between the buckets (common with the quantized sketch
+        # quantiles), so no price score
+        return None
 
     qscore = 1.0 - (qvol / avol) / mss
-    vscore = math.log(avol / SAMPLE_COUNT)
+    vscore = math.log(avol / sample_count)
     pscore = math.log(bucket_diff * (bucket_avg / avg_bo_ppq))
 
+    return (item_id, qscore, vscore, pscore,
+        (small_low, small_avg, small_diff, small_high),
+        (avg_bo_ppq, bucket_avg),
+        (large_low, large_avg, large_diff, large_high))
+
+def score_raw_item(args):
+    """Process pool entry point, scores an item from its raw auction columns."""
+    item_id, mss, avol, qvol, tbo, sample_count, quantities, buyouts = args
+    ppq = (buyouts / quantities) / GOLD_QUOTIENT
+    large = ppq[quantities > int(mss * PCT_LARGE)]
+    small = ppq[quantities < int(mss * PCT_SMALL)]
+    return score_item(item_id, mss, avol, qvol, tbo, sample_count,
+        lambda pct: percentile(large, pct),
+        lambda pct: percentile(small, pct))
+
+def iter_raw_items(db, start_time, sample_count):
+    """Stream the window's buyouts once, yielding work for candidate items.
+
+    If the window has more partitions than one query can use, the rows of
+    every batch of them are gathered per item first.
+    """
+    batches = PARTITIONS.route_batches(start_time, datetime.datetime.utcnow())
+    if len(batches) == 1:
+        items = iter_item_rows(db, batches[0](), start_time)
+    else:
+        gathered = collections.defaultdict(list)
+        for route in batches:
+            for item_id, rows in iter_item_rows(db, route(), start_time):
+                gathered[item_id].extend(rows)
+        items = sorted(gathered.iteritems())
+    for item_id, rows in items:
+        work = make_raw_work(item_id, rows, sample_count)
+        if work is not None:
+            yield work
+
+def iter_item_rows(db, auction, start_time):
+    """Yield (item_id, [(quantity, buyout), ...]) for the buyouts in ``auction``."""
+    cursor = db.execute_sql(STMT_BUYOUTS.format(auction=auction).replace('?', db.interpolation),
+        (start_time,))
+    item_id, rows = None, []
+    while True:
+        batch = cursor.fetchmany(FETCH_SIZE)
+        for row in batch:
+            if row[0] != item_id:
+                if rows:
+                    yield item_id, rows
+                item_id, rows = row[0], []
+            rows.append(row[1:])
+        if not batch:
+            break
+    if rows:
+        yield item_id, rows
+
+def make_raw_work(item_id, rows, sample_count):
+    quantities, buyouts = numpy.array(rows, dtype=numpy.float64).T
+    mss = int(quantities.max())
+    avol = len(quantities)
+    if not is_candidate(mss, avol, sample_count):
+        return None
+    return (item_id, mss, avol, int(quantities.sum()), int(buyouts.sum()), sample_count,
+        quantities, buyouts)
+
+def score_raw(db, start_time, sample_count, workers):
+    """Yield scores for every candidate item, in item ID order."""
+    if workers <= 1:
+        for work in iter_raw_items(db, start_time, sample_count):
+            yield score_raw_item(work)
+        return
+    pool = multiprocessing.Pool(workers)
+    pending = collections.deque()
+    try:
+        for work in iter_raw_items(db, start_time, sample_count):
+            pending.append(pool.apply_async(score_raw_item, (work,)))
+            if len(pending) > workers * 4:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def score_sketches(db, start_time, sample_count):
+    """Yield scores for every candidate item from ItemStats and PriceSketch."""
+    sketches = PriceSketch.load_window(start_time)
+    # the hourly ItemStats buckets can include up to an hour before start_time
+    for item_id, mss, avol, qvol, tbo in db.execute_sql(
+            STMT_QUANTITY_STATS.replace('?', db.interpolation),
+            params=(ItemStats.get_period_start('hour', start_time),)):
+        if not is_candidate(mss, avol, sample_count):
+            continue
+        item_sketches = sketches.get(item_id, {})
+        large = PriceSketch.merge_quantities(item_sketches, min_quantity=int(mss * PCT_LARGE))
+        small = PriceSketch.merge_quantities(item_sketches, max_quantity=int(mss * PCT_SMALL))
+        yield score_item(item_id, mss, avol, qvol, tbo, sample_count,
+            lambda pct: large.quantile(pct) / GOLD_QUOTIENT,
+            lambda pct: small.quantile(pct) / GOLD_QUOTIENT)
+
+def write_score(score, item_name):
+    item_id, qscore, vscore, pscore, small, avgs, large = score
     sys.stdout.write(','.join(str(e) for e in [
-        item_id, get_item_name(item_id),
+        item_id, item_name,
         qscore, vscore, pscore, \
         (qscore * vscore * pscore), (qscore * (pscore / vscore))
     ]) + '\n')
 
     sys.stderr.write(' '.join(str(e) for e in [
         item_id, \
-        '|{:3.1f} < {:3.1f}+/-{:3.1f} < {:3.1f}|'.format(small_low, small_avg, small_diff, small_high), \
-        '<< {:3.1f} ({:3.1f}) <<'.format(avg_bo_ppq, bucket_avg), \
-        '|{:3.1f} < {:3.1f}+/-{:3.1f} < {:3.1f}|'.format(large_low, large_avg, large_diff, large_high)
+        '|{:3.1f} < {:3.1f}+/-{:3.1f} < {:3.1f}|'.format(*small), \
+        '<< {:3.1f} ({:3.1f}) <<'.format(*avgs), \
+        '|{:3.1f} < {:3.1f}+/-{:3.1f} < {:3.1f}|'.format(*large)
     ]) + '\n')
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] DB_URL LOOK_BACK_DAYS')
+    parser.add_option('-w', '--workers', type='int', default=multiprocessing.cpu_count())
+    parser.add_option('--sketches', action='store_true', default=False,
+        help='use the stored ItemStats/PriceSketch aggregates instead of raw auctions, '
+            'the percentiles (and so the pscores) are then approximate')
+    parser.add_option('--offline', action='store_true', default=False,
+        help='only use cached item names, never look them up')
+
+    opts, args = parser.parse_args()
+    db_url, look_back_days = args
+
+    DB = db_connect(db_url)
+    START_TIME = datetime.datetime.utcnow() - datetime.timedelta(days=int(look_back_days))
+    # one ParsedFile per realm group and dump, count each dump time once
+    SAMPLE_COUNT = ParsedFile.select(ParsedFile.timestamp).where(
+        ParsedFile.timestamp >= START_TIME).distinct().count()
+
+    if opts.sketches:
+        scores = score_sketches(DB, START_TIME, SAMPLE_COUNT)
+    else:
+        scores = score_raw(DB, START_TIME, SAMPLE_COUNT, opts.workers)
+    scores = [s for s in scores if s is not None]
+    item_names = ItemNameCache(offline=opts.offline, max_size=max(len(scores), 1))
+    item_names.prefetch(s[0] for s in scores)
+    for score in scores:
+        name = item_names.get(score[0])
+        write_score(score, (name or '').encode('utf-8'))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python2
+
+import os
+import os.path
+import bz2
+import json
+import random
+import bisect
+import hashlib
+import calendar
+import datetime
+import collections
+import optparse
+
+from wowah import Snapshot, logger
+
+STACK_SIZES     = [1, 5, 10, 20, 50, 100, 200]
+DURATIONS       = [12, 24, 48]
+# dumps report the time left as the bucket it falls into
+TIME_LEFT_LIMITS = [(Snapshot.TIME_LEFT_ENUM[name], name) for name in ('SHORT', 'MEDIUM', 'LONG')]
+
+def get_time_left(remaining):
+    for limit, name in TIME_LEFT_LIMITS:
+        if remaining <= limit:
+            return name
+    return 'VERY_LONG'
+
+class DumpGenerator(object):
+    """Writes a sequence of hourly synthetic auction dumps.
+
+    The auction house holds about ``auctions`` auctions at any time. Each
+    hour every auction ends early with probability ``churn`` (bought out or
+    cancelled), or expires at the end of its duration, and is replaced by a
+    new one. Items are picked with a Zipf-like popularity of ``item_skew``,
+    so a few items make up most of the auctions. The output only depends on
+    the options and ``seed``.
+    """
+    BID_CHANGE_RATE     = 0.05
+    BID_ONLY_RATE       = 0.1
+    BONUS_SET_COUNT     = 50
+
+    def __init__(self, realms=3, auctions=50000, items=5000, item_skew=1.1, owners=2000,
+            churn=0.1, bonus_rate=0.2, seed=0, first_realm=0):
+        self._random = random.Random(seed)
+        self._realms = [{'name': 'Realm {}'.format(i), 'slug': 'realm-{}'.format(i)} \
+            for i in range(first_realm, first_realm + realms)]
+        self._realm_hash = hashlib.md5('+'.join(r['slug'] for r in self._realms)).hexdigest()
+        self._size = auctions
+        self._churn = churn
+        self._owners = ['Owner{}'.format(i) for i in range(owners)]
+        self._items = [{
+            'id':       i + 1,
+            'mss':      self._random.choice(STACK_SIZES),
+            'ppi':      int(self._random.lognormvariate(9, 2)) + 1,
+            'bonus':    self._random.random() < bonus_rate,
+        } for i in range(items)]
+        self._item_cdf = []
+        total = 0.0
+        for rank in range(1, items + 1):
+            total += 1.0 / (rank ** item_skew)
+            self._item_cdf.append(total)
+        self._bonus_sets = [sorted(self._random.sample(range(1, 2000), self._random.randint(1, 4))) \
+            for _ in range(self.BONUS_SET_COUNT)]
+        self._next_auc_id = 1
+        # auc -> (auction dict, expires at)
+        self._active = {}
+
+    def write(self, path, start, hours):
+        for ts, dump in self.generate(start, hours):
+            fn = os.path.join(path, 'auctions-{}-{}.json.bz2'.format(
+                calendar.timegm(ts.utctimetuple()) * 1000, self._realm_hash))
+            with bz2.BZ2File(fn, 'w') as handle:
+                json.dump(dump, handle)
+            logger.info('Wrote %s: %d auctions', fn, len(dump['auctions']))
+
+    def generate(self, start, hours):
+        for hour in range(hours):
+            ts = start + datetime.timedelta(hours=hour)
+            self._step(ts, initial=(hour == 0))
+            yield ts, self._get_dump(ts)
+
+    def _step(self, ts, initial):
+        for auc_id, (auction, expires_at) in self._active.items():
+            if expires_at <= ts or self._random.random() < self._churn:
+                del self._active[auc_id]
+            elif self._random.random() < self.BID_CHANGE_RATE:
+                auction['bid'] += max(1, auction['bid'] // 20)
+        while len(self._active) < self._size:
+            self._add_auction(ts, initial)
+
+    def _add_auction(self, ts, initial):
+        rand = self._random
+        item = self._items[bisect.bisect_left(self._item_cdf, rand.random() * self._item_cdf[-1])]
+        quantity = item['mss'] if rand.random() < 0.5 else rand.randint(1, item['mss'])
+        buyout = max(1, int(item['ppi'] * quantity * rand.uniform(0.8, 1.3)))
+        auction = {
+            'auc':          self._next_auc_id,
+            'item':         item['id'],
+            'owner':        rand.choice(self._owners),
+            'ownerRealm':   rand.choice(self._realms)['name'],
+            'bid':          max(1, int(buyout * rand.uniform(0.5, 0.95))),
+            'buyout':       0 if rand.random() < self.BID_ONLY_RATE else buyout,
+            'quantity':     quantity,
+            'rand':         0,
+            'seed':         rand.randint(0, 2 ** 31 - 1),
+            'context':      0,
+        }
+        if item['bonus']:
+            auction['context'] = rand.randint(1, 30)
+            auction['bonusLists'] = [{'bonusListId': b} for b in rand.choice(self._bonus_sets)]
+            auction['modifiers'] = [{'type': 9, 'value': rand.randint(1, 110)}]
+        duration = datetime.timedelta(hours=rand.choice(DURATIONS))
+        # the first dump starts with auctions of every age
+        elapsed = datetime.timedelta(seconds=rand.uniform(0, duration.total_seconds())) \
+            if initial else datetime.timedelta(0)
+        self._active[self._next_auc_id] = (auction, ts - elapsed + duration)
+        self._next_auc_id += 1
+
+    def _get_dump(self, ts):
+        auctions = []
+        for auc_id in sorted(self._active):
+            auction, expires_at = self._active[auc_id]
+            auction['timeLeft'] = get_time_left((expires_at - ts).total_seconds())
+            auctions.append(auction)
+        # realms first, so that DataSource(streaming=True) can read them up front
+        return collections.OrderedDict([('realms', self._realms), ('auctions', auctions)])
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] OUT_PATH')
+    parser.add_option('-r', '--realms', type='int', default=3,
+        help='number of connected realms')
+    parser.add_option('--first-realm', type='int', default=0,
+        help='number of the first realm, use different ones for each realm group')
+    parser.add_option('-a', '--auctions', type='int', default=50000,
+        help='number of active auctions in each dump')
+    parser.add_option('-i', '--items', type='int', default=5000,
+        help='number of distinct items')
+    parser.add_option('--item-skew', type='float', default=1.1,
+        help='Zipf exponent of the item popularity')
+    parser.add_option('-o', '--owners', type='int', default=2000)
+    parser.add_option('-c', '--churn', type='float', default=0.1,
+        help='chance that an auction ends early, each hour')
+    parser.add_option('--bonus-rate', type='float', default=0.2,
+        help='fraction of items with bonus lists and modifiers')
+    parser.add_option('-n', '--hours', type='int', default=24,
+        help='number of hourly dumps to write')
+    parser.add_option('-s', '--start', type='int', default=1478000000,
+        help='unix timestamp of the first dump')
+    parser.add_option('--seed', type='int', default=0)
+
+    opts, args = parser.parse_args()
+    out_path, = args
+
+    if not os.path.isdir(out_path):
+        os.makedirs(out_path)
+    generator = DumpGenerator(realms=opts.realms, auctions=opts.auctions, items=opts.items,
+        item_skew=opts.item_skew, owners=opts.owners, churn=opts.churn,
+        bonus_rate=opts.bonus_rate, seed=opts.seed, first_realm=opts.first_realm)
+    start = datetime.datetime.utcfromtimestamp(opts.start).replace(minute=0, second=0)
+    generator.write(out_path, start, opts.hours)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python2
+
+from __future__ import division
+
+import sys
+import random
+import datetime
+import optparse
+
+from wowah import PriceHistory, db_connect, downsample_lttb
+
+GOLD_QUOTIENT = 10000
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+def write_points(points, quantity_max, jitter):
+    """Write ``bo_ppq|ts|qs|runtime`` rows, as contrib/item-price-history.plot reads them."""
+    for ended_at, ppi, quantity, hours in points:
+        # spread out auctions that ended in the same dump
+        ts = ended_at + datetime.timedelta(seconds=random.randint(-jitter, jitter))
+        sys.stdout.write('{}|{}|{}|{}\n'.format(ppi / GOLD_QUOTIENT, ts.strftime(TIME_FORMAT),
+            quantity / quantity_max if quantity_max else 0, hours))
+
+def write_buckets(buckets):
+    for bucket_start, count, ppi_min, ppi_median, ppi_max in buckets:
+        sys.stdout.write('{}|{}|{}|{}|{}\n'.format(bucket_start.strftime(TIME_FORMAT), count,
+            ppi_min / GOLD_QUOTIENT, (ppi_median or 0) / GOLD_QUOTIENT, ppi_max / GOLD_QUOTIENT))
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] DB_URL ITEM_ID')
+    parser.add_option('-d', '--days', type='int', default=30,
+        help='days to look back, unless --start is given')
+    parser.add_option('-s', '--start', default=None, help='first day (YYYY-MM-DD)')
+    parser.add_option('-e', '--end', default=None, help='day to end before (YYYY-MM-DD), defaults to now')
+    parser.add_option('-r', '--realm-key', default=None,
+        help='only this realm group, defaults to all of them')
+    parser.add_option('-b', '--bucket-hours', type='int', default=0,
+        help='write bucket_start|count|min|median|max rows of this many hours '
+            'from the precomputed stats instead of single auctions')
+    parser.add_option('-l', '--lttb', type='int', default=0,
+        help='downsample the auctions to this many points')
+    parser.add_option('--max-ratio', type='float', default=2.0,
+        help='leave out auctions priced over this many times the average')
+    parser.add_option('--jitter-minutes', type='int', default=30)
+
+    opts, args = parser.parse_args()
+    db_url, item_id = args
+    item_id = int(item_id)
+
+    db_connect(db_url)
+    end = parse_date(opts.end) if opts.end else datetime.datetime.utcnow()
+    start = parse_date(opts.start) if opts.start else end - datetime.timedelta(days=opts.days)
+
+    history = PriceHistory()
+    if opts.bucket_hours:
+        write_buckets(history.buckets(item_id, start, end, opts.bucket_hours, realm_key=opts.realm_key))
+    else:
+        points = history.points(item_id, start, end, realm_key=opts.realm_key,
+            max_ratio=opts.max_ratio or None)
+        if opts.lttb:
+            points = downsample_lttb(points, opts.lttb)
+        quantity_max = history.summary(item_id, start, end, realm_key=opts.realm_key)['quantity_max']
+        write_points(points, quantity_max, opts.jitter_minutes * 60)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python2
+
+from __future__ import division
+
+import os.path
+import sys
+import imp
+import json
+import time
+import resource
+import datetime
+import contextlib
+import collections
+import optparse
+
+from wowah import MODELS, ParsedFile, DataSource, DataManager, MetricsSink, QuantileSketch, \
+    RealmImporter, ResultEstimator, db_connect, logger
+
+# the scoring functions live in a script, not the module
+FIND_PRICE_SCORES_FN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'find-price-scores.py')
+PHASES          = ['load', 'import', 'estimate', 'score_raw', 'score_sketches']
+
+class PhaseTimer(object):
+    def __init__(self):
+        self.timings = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.time() - start
+
+class TotalsSink(MetricsSink):
+    """Sums the ImportStats of every dump in the run."""
+    def __init__(self):
+        self.dumps = 0
+        self.timings = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+    def write(self, ts, realm_key, stats):
+        self.dumps += 1
+        for name, seconds in stats.timings.iteritems():
+            self.timings[name] = self.timings.get(name, 0) + seconds
+        for name, value in stats.counters.iteritems():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+def iter_counted(data_src, timer, counts):
+    """Pass the dumps through, timing their loading and counting rows."""
+    dumps = iter(data_src)
+    while True:
+        with timer.phase('load'):
+            try:
+                data = next(dumps)
+            except StopIteration:
+                return
+        counts['files'] += 1
+        data['auctions'] = count_auctions(data['auctions'], counts)
+        yield data
+
+def count_auctions(auctions, counts):
+    for a in auctions:
+        counts['rows'] += 1
+        yield a
+
+def check_sketch_scores(raw_scores, sketch_scores, tolerance):
+    """Compare the bucket percentiles of the items scored both ways.
+
+    Both sides take the same rank of the same auctions, so the sketch
+    percentiles should be within the sketch's relative accuracy. The
+    pscores can differ much more, they are the log of a difference.
+    """
+    raw = dict((s[0], s) for s in raw_scores if s is not None)
+    sketches = dict((s[0], s) for s in sketch_scores if s is not None)
+    both = sorted(set(raw) & set(sketches))
+    max_error = max_pscore_diff = 0.0
+    failed = []
+    for item_id in both:
+        r, s = raw[item_id], sketches[item_id]
+        # (small low, small high, large low, large high)
+        errors = [abs(s_pct - r_pct) / r_pct for r_pct, s_pct in zip(
+            (r[4][0], r[4][3], r[6][0], r[6][3]), (s[4][0], s[4][3], s[6][0], s[6][3]))]
+        max_error = max([max_error] + errors)
+        max_pscore_diff = max(max_pscore_diff, abs(r[3] - s[3]))
+        if max(errors) > tolerance * (1 + 1e-9):
+            failed.append(item_id)
+    return collections.OrderedDict([
+        ('tolerance',           tolerance),
+        ('items_raw',           len(raw)),
+        ('items_sketches',      len(sketches)),
+        ('items_both',          len(both)),
+        ('max_pct_error',       max_error),
+        ('max_pscore_diff',     max_pscore_diff),
+        ('items_failed',        failed),
+    ])
+
+def get_peak_rss():
+    """Peak RSS in MB of this process and of its (worker) children."""
+    # ru_maxrss is in KB on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+def write_report(report):
+    sys.stdout.write('{:<20} {}\n'.format('database', report['database']))
+    for name, value in report['options'].iteritems():
+        sys.stdout.write('{:<20} {}\n'.format(name, value))
+    sys.stdout.write('{:<20} {}\n'.format('files', report['files']))
+    sys.stdout.write('{:<20} {}\n'.format('rows', report['rows']))
+    for name, seconds in report['timings'].iteritems():
+        sys.stdout.write('{:<20} {:.3f}s\n'.format(name, seconds))
+    for name, seconds in report['import_timings'].iteritems():
+        sys.stdout.write('{:<20} {:.3f}s\n'.format('  ' + name, seconds))
+    for name, value in report['import_counters'].iteritems():
+        sys.stdout.write('{:<20} {}\n'.format('  ' + name, value))
+    sys.stdout.write('{:<20} {:.2f}\n'.format('files/sec', report['files_per_sec']))
+    sys.stdout.write('{:<20} {:.1f}\n'.format('rows/sec', report['rows_per_sec']))
+    sys.stdout.write('{:<20} {:.1f} MB\n'.format('peak rss', report['peak_rss_mb']))
+    sys.stdout.write('{:<20} {:.1f} MB\n'.format('peak rss (workers)', report['peak_rss_workers_mb']))
+    check = report['sketch_check']
+    if check is not None:
+        sys.stdout.write('{:<20} {}/{} items in both, {} outside {:.1%}\n'.format('sketch check',
+            check['items_both'], max(check['items_raw'], check['items_sketches']),
+            len(check['items_failed']), check['tolerance']))
+        sys.stdout.write('{:<20} {:.3%}\n'.format('  max pct error', check['max_pct_error']))
+        sys.stdout.write('{:<20} {:.3f}\n'.format('  max pscore diff', check['max_pscore_diff']))
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] DB_URL DATA_PATH')
+    parser.add_option('-b', '--batch-size', type='int', default=50)
+    parser.add_option('-S', '--streaming', action='store_true', default=False,
+        help='stream the dumps, part of the load time then counts as import time')
+    parser.add_option('-w', '--workers', type='int', default=0)
+    parser.add_option('-R', '--realm-workers', type='int', default=0,
+        help='import the realm groups in DATA_PATH in parallel, load times are then not known')
+    parser.add_option('--staging', action='store_true', default=False)
+    parser.add_option('--reset', action='store_true', default=False,
+        help='drop all tables before importing')
+    parser.add_option('-x', '--skip', action='append', default=[],
+        choices=PHASES[2:], help='phase to skip, can be given more than once')
+    parser.add_option('-o', '--output', default=None,
+        help='also write the report as JSON to this file')
+    parser.add_option('--sketch-tolerance', type='float', default=QuantileSketch().relative_accuracy,
+        help='largest relative error of the sketch percentiles against the raw ones, '
+            'exits with 1 when exceeded (default: the sketch accuracy, %default)')
+
+    opts, args = parser.parse_args()
+    db_url, data_path = args
+    if opts.realm_workers and opts.workers:
+        parser.error('--realm-workers can not be used with --workers')
+
+    db = db_connect(db_url)
+    if opts.reset:
+        db.drop_tables(MODELS, safe=True, cascade=db.drop_cascade)
+        db = db_connect(db_url)
+
+    timer = PhaseTimer()
+    counts = collections.Counter()
+    totals = TotalsSink()
+    if opts.realm_workers:
+        with timer.phase('import'):
+            RealmImporter(db_url, data_path, opts.realm_workers, streaming=opts.streaming,
+                sinks=[totals]).import_data(batch_size=opts.batch_size, staging=opts.staging)
+        counts['files'] = totals.dumps
+        counts['rows'] = totals.counters.get('auctions', 0)
+    else:
+        data_src = DataSource(data_path, streaming=opts.streaming, workers=opts.workers)
+        with timer.phase('import'):
+            DataManager(sinks=[totals]).import_data(iter_counted(data_src, timer, counts),
+                batch_size=opts.batch_size, staging=opts.staging)
+        # import_data() pulls the dumps, so its time includes loading them
+        timer.timings['import'] -= timer.timings.get('load', 0)
+    import_seconds = timer.timings['import'] + timer.timings.get('load', 0)
+
+    first_ts = ParsedFile.select(ParsedFile.timestamp).order_by(
+        ParsedFile.timestamp.asc()).scalar(convert=True)
+    last_ts = ParsedFile.select(ParsedFile.timestamp).order_by(
+        ParsedFile.timestamp.desc()).scalar(convert=True)
+    if first_ts is not None and 'estimate' not in opts.skip:
+        logger.info('Estimating results...')
+        with timer.phase('estimate'):
+            ResultEstimator().estimate(first_ts, last_ts)
+    raw_scores = sketch_scores = None
+    if first_ts is not None:
+        scores = imp.load_source('find_price_scores', FIND_PRICE_SCORES_FN)
+        sample_count = ParsedFile.select(ParsedFile.timestamp).distinct().count()
+        if 'score_raw' not in opts.skip:
+            logger.info('Scoring from raw auctions...')
+            with timer.phase('score_raw'):
+                raw_scores = list(scores.score_raw(db, first_ts, sample_count, opts.workers))
+        if 'score_sketches' not in opts.skip:
+            logger.info('Scoring from sketches...')
+            with timer.phase('score_sketches'):
+                sketch_scores = list(scores.score_sketches(db, first_ts, sample_count))
+    sketch_check = None
+    if raw_scores is not None and sketch_scores is not None:
+        sketch_check = check_sketch_scores(raw_scores, sketch_scores, opts.sketch_tolerance)
+
+    peak_rss, peak_rss_workers = get_peak_rss()
+    report = collections.OrderedDict([
+        ('database',            type(db).__name__),
+        ('options',             collections.OrderedDict([
+            ('batch_size',      opts.batch_size),
+            ('streaming',       opts.streaming),
+            ('workers',         opts.workers),
+            ('realm_workers',   opts.realm_workers),
+            ('staging',         opts.staging),
+        ])),
+        ('finished_at',         datetime.datetime.utcnow().isoformat()),
+        ('files',               counts['files']),
+        ('rows',                counts['rows']),
+        ('timings',             timer.timings),
+        # the per dump phases from ImportStats, summed
+        ('import_timings',      totals.timings),
+        ('import_counters',     totals.counters),
+        ('files_per_sec',       counts['files'] / import_seconds if import_seconds else 0),
+        ('rows_per_sec',        counts['rows'] / import_seconds if import_seconds else 0),
+        ('peak_rss_mb',         peak_rss),
+        ('peak_rss_workers_mb', peak_rss_workers),
+        # the sketch percentiles against the raw ones, see check_sketch_scores()
+        ('sketch_check',        sketch_check),
+    ])
+    write_report(report)
+    if opts.output:
+        with open(opts.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+    if sketch_check is not None and sketch_check['items_failed']:
+        logger.error('Sketch percentiles outside the tolerance for items: %s',
+            ', '.join(str(i) for i in sketch_check['items_failed']))
+        sys.exit(1)
@@ -1,7 +1,9 @@
 #!/usr/bin/env python2
 
 import uuid
+import os
 import os.path
+import shutil
 import bz2
 import glob
 import logging
@@ -9,12 +11,37 @@ import datetime
 import json
 import re
 import itertools
+import codecs
+import collections
+import io
+import multiprocessing
+import Queue
+import calendar
+import bisect
+import math
+import hashlib
+import time
+import contextlib
+import functools
+import urllib2
+from multiprocessing.pool import ThreadPool
 
 # import peewee
 from peewee import *
-from playhouse.db_url import connect as db_url_connect
+from playhouse.db_url import connect as db_url_connect, register_database
+from playhouse.migrate import SchemaMigrator, migrate
 from tqdm import tqdm
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
 # logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 logging.getLogger('peewee').setLevel(logging.INFO)
@@ -33,10 +60,58 @@ class DataModel(Model):
     # guid                = UUIDField(default=uuid.uuid4, index=True, unique=True)
     Meta = GlobalMeta
 
+class AttributeKey(DataModel):
+    """Interned item attribute names, e.g. ``bonusListId`` or ``modifiers-type-9``."""
+    name                = CharField(unique=True)
+
+class AttributeSet(DataModel):
+    """A distinct set of item attributes (bonus lists, modifiers, ...).
+
+    Each set is stored once, as AttributeSetMember rows, and shared by every
+    Auction with exactly those (name, value) pairs.
+    """
+    digest              = CharField(unique=True)
+    size                = IntegerField()
+
+    @classmethod
+    def get_digest(cls, attrs):
+        return hashlib.sha1(json.dumps(sorted(attrs))).hexdigest()
+
+    @classmethod
+    def matching(cls, name, value):
+        """Return a subquery of the IDs of the sets containing name=value.
+
+        e.g. ``Auction.select().where(Auction.attr_set << AttributeSet.matching('bonusListId', 1472))``
+        """
+        return AttributeSetMember.select(AttributeSetMember.attr_set).join(AttributeKey).where(
+            (AttributeKey.name == name) &
+            (AttributeSetMember.value == value)
+        )
+
+    def get_attributes(self):
+        return [(name, value) for name, value in AttributeSetMember.select(
+                AttributeKey.name, AttributeSetMember.value
+            ).join(AttributeKey).where(
+                AttributeSetMember.attr_set == self
+            ).tuples()]
+
+class AttributeSetMember(DataModel):
+    attr_set            = ForeignKeyField(AttributeSet, related_name='members')
+    key                 = ForeignKeyField(AttributeKey, related_name='members')
+    value               = IntegerField()
+
+    class Meta(GlobalMeta):
+        indexes         = (
+            # AttributeSet.matching() lookups
+            (('key', 'value'), False),
+        )
+
 class Auction(DataModel):
     auc_id              = IntegerField(index=True)
     owner               = CharField(default=None, null=True, index=True)
     owner_realm         = CharField(default=None, null=True)
+    # the connected realm group (ParsedFile.realm_key) of the auction house
+    realm_key           = CharField(default=None, null=True)
 
     quantity            = IntegerField(
         constraints=[Check('quantity > 0')])
@@ -47,6 +122,8 @@ class Auction(DataModel):
     rand                = IntegerField(default=0)
     seed                = IntegerField(default=0)
     context             = IntegerField(default=0)
+    attr_set            = ForeignKeyField(AttributeSet, default=None, null=True,
+        related_name='auctions')
 
     started_at          = DateTimeField(index=True)
     ended_at            = DateTimeField(default=None, null=True, index=True)
@@ -56,9 +133,23 @@ class Auction(DataModel):
     est_ended_at        = DateTimeField(default=None, null=True)
     est_started_at      = DateTimeField(default=None, null=True)
 
+    # summary of the snapshots, once they have been compacted away, see
+    # DataManager.compact_snapshots()
+    snapshot_count      = IntegerField(default=None, null=True)
+    first_bid           = IntegerField(default=None, null=True)
+    last_bid            = IntegerField(default=None, null=True)
+    bid_change_count    = IntegerField(default=None, null=True)
+    first_time_left     = IntegerField(default=None, null=True)
+
     class Meta(GlobalMeta):
         indexes         = (
             (('auc_id', 'owner_realm', 'started_at'), True),
+            # get_siblings() lookups
+            (('item_id', 'started_at'), False),
+            (('item_id', 'ended_at'), False),
+            # per realm group import lookups
+            (('realm_key', 'started_at'), False),
+            (('realm_key', 'ended_at'), False),
         )
 
     # a mapping of model keys to json object keys
@@ -84,10 +175,10 @@ class Auction(DataModel):
         dt = datetime.timedelta(days=day_buffer)
         if timestamp is None:
             timestamp = datetime.datetime.utcnow()
-        return cls.get(
+        return PARTITIONS.select(cls.select().where(
             (cls.auc_id == auc_id) &
             cls.started_at.between(timestamp - dt, timestamp + dt)
-        )
+        ), timestamp - dt, timestamp + dt).get()
 
     @classmethod
     def from_json(cls, obj, ts):
@@ -98,8 +189,31 @@ class Auction(DataModel):
             model_dict[k] = obj[v]
         return model_dict
 
+    @classmethod
+    def from_record(cls, record, ts):
+        model_dict = {
+            'started_at': ts,
+        }
+        for k in cls.KEY_MAP:
+            model_dict[k] = getattr(record, k)
+        return model_dict
+
+    @property
+    def attributes(self):
+        """The item's (name, value) attribute pairs."""
+        if self._data.get('attr_set') is None:
+            # imported before AttributeSet, see DataManager.normalize_item_attributes()
+            return [(a.attribute, a.value) for a in self.item_attrs]
+        return self.attr_set.get_attributes()
+
+    @property
+    def is_compacted(self):
+        return self.snapshot_count is not None
+
     @property
     def bid_count(self):
+        if self.is_compacted:
+            return self.bid_change_count
         snaps = sorted(self.snapshots, key=lambda s: s.timestamp)
         bid_count = len([None for i in range(len(snaps)-1) if snaps[i+1].bid - snaps[i].bid])
         return bid_count
@@ -111,20 +225,31 @@ class Auction(DataModel):
     def estimate_ended_at(self):
         # if self.ended_at is not None:
         #     return self.ended_at
-        snaps = sorted(self.snapshots, key=lambda s: s.timestamp)
+        if self.is_compacted:
+            snap_count, first_time_left = self.snapshot_count, self.first_time_left
+        else:
+            snaps = sorted(self.snapshots, key=lambda s: s.timestamp)
+            snap_count, first_time_left = len(snaps), snaps[0].time_left
         return self.started_at + \
-            (datetime.timedelta(seconds=snaps[0].time_left) - \
-                (len(snaps) * datetime.timedelta(hours=1))) + \
+            (datetime.timedelta(seconds=first_time_left) - \
+                (snap_count * datetime.timedelta(hours=1))) + \
             (self.bid_count * datetime.timedelta(minutes=5))
 
 
-    def estimate_result(self, force=False):
+    def estimate_result(self, force=False, siblings=None):
+        """Estimate how the auction ended.
+
+        ``siblings`` is an optional AuctionIntervalIndex holding the buyout
+        auctions around this one, to look them up in instead of the DB.
+        """
         if self.ended_at is None:
             raise ValueError('Auction has not ended')
         if self.est_result is not None and not force:
             return self.est_result
+        if self.is_compacted:
+            raise ValueError('Auction snapshots have been compacted')
         snaps = Snapshot.select().where(Snapshot.auction == self).order_by(Snapshot.timestamp.asc())
-        auction_siblings = self.get_siblings()
+        auction_siblings = self.get_siblings() if siblings is None else siblings.get_siblings(self)
         final_snapshot_siblings = snaps[-1].get_siblings()
 
         run_time = self.ended_at - self.started_at
@@ -162,17 +287,21 @@ class Auction(DataModel):
     def get_siblings(self, strict=False):
         conditions = \
             (Auction.id != self.id) & \
+            (Auction.realm_key == self.realm_key) & \
             (Auction.item_id == self.item_id) & \
             Auction.buyout.is_null(self.buyout is None)
         if self.ended_at is None:
             conditions &= \
                 ((Auction.started_at >= self.started_at) | \
                 Auction.ended_at.is_null(True))
+            end = datetime.datetime.utcnow()
         else:
             conditions &= \
                 (Auction.started_at.between(self.started_at, self.ended_at) | \
                 Auction.ended_at.between(self.started_at, self.ended_at))
-        return Auction.select().where(conditions).order_by(Auction.started_at.asc())
+            end = self.ended_at
+        return PARTITIONS.select(Auction.select().where(conditions).order_by(Auction.started_at.asc()),
+            self.started_at - MAX_AUCTION_DURATION, end)
 
 class Snapshot(DataModel):
     auction             = ForeignKeyField(Auction, related_name='snapshots')
@@ -182,6 +311,11 @@ class Snapshot(DataModel):
         constraints=[Check('bid > 0')])
     time_left           = IntegerField()
 
+    class Meta(GlobalMeta):
+        indexes         = (
+            (('auction', 'timestamp'), False),
+        )
+
     TIME_LEFT_ENUM      = {
         'VERY_LONG':        48 * 60 * 60,
         'LONG':             12 * 60 * 60,
@@ -189,6 +323,9 @@ class Snapshot(DataModel):
         'SHORT':                 30 * 60,
     }
 
+    # column order of to_row() for BulkWriter
+    ROW_COLUMNS         = ['auction_id', 'timestamp', 'bid', 'time_left']
+
     @classmethod
     def from_json(cls, auction, obj, ts):
         return {
@@ -198,18 +335,33 @@ class Snapshot(DataModel):
             'time_left':    obj['timeLeft'],
         }
 
+    @classmethod
+    def to_row(cls, auction_id, record, ts):
+        return (auction_id, ts, record.bid, record.time_left)
+
     @property
     def bid_ppi(self):
         return self.bid / self.auction.quantity
 
     def get_siblings(self, strict=True):
-        return Snapshot.select().join(Auction).where(
+        # the started_at/ended_at conditions are implied by the timestamp but
+        # let the (item_id, started_at) and (auction, timestamp) indexes be used
+        # their auctions are needed too, so load them along
+        return Snapshot.select(Snapshot, Auction).join(Auction).where(
             (Snapshot.id != self.id) &
+            (Auction.realm_key == self.auction.realm_key) &
             (Auction.item_id == self.auction.item_id) &
+            (Auction.started_at <= self.timestamp) &
+            (Auction.ended_at.is_null(True) | (Auction.ended_at > self.timestamp)) &
             (Snapshot.timestamp == self.timestamp)
         )
 
 class ItemAttribute(DataModel):
+    """One row per attribute per auction, superseded by Auction.attr_set.
+
+    Only data imported before AttributeSet existed is stored here, see
+    DataManager.normalize_item_attributes().
+    """
     auction             = ForeignKeyField(Auction, related_name='item_attrs')
 
     attribute           = CharField(index=True)
@@ -217,67 +369,1155 @@ class ItemAttribute(DataModel):
 
     @classmethod
     def from_json(cls, auction, obj):
+        for key, value in cls._iter_attributes(obj):
+            yield {'auction': auction, 'attribute': key, 'value': value}
+
+    @classmethod
+    def _iter_attributes(cls, obj):
         for k in set(obj.keys()) - set(Auction.ITEM_META_IGNORE_KEYS):
             key = k
             if k == 'modifiers':
                 for m in obj[k]:
                     key = '{}-{}-{}'.format(k, 'type', m['type'])
-                    yield {'auction': auction, 'attribute': key, 'value': m['value']}
+                    yield (key, m['value'])
             elif k == 'bonusLists':
                 for b in obj[k]:
                     key = 'bonusListId'
-                    yield {'auction': auction, 'attribute': key, 'value': b['bonusListId']}
+                    yield (key, b['bonusListId'])
             else:
-                yield {'auction': auction, 'attribute': key, 'value': obj[key]}
+                yield (key, obj[key])
 
 class ParsedFile(DataModel):
     realm_key           = CharField()
     hash                = CharField()
-    timestamp           = DateTimeField(index=True, unique=True)
+    timestamp           = DateTimeField(index=True)
+
+    class Meta(GlobalMeta):
+        indexes         = (
+            # realm groups usually dump at the same times
+            (('realm_key', 'timestamp'), True),
+        )
+
+class ItemStats(DataModel):
+    """Per realm group, per item aggregates for each hour and day, see
+    DataManager.import_data().
 
-MODELS = [Auction, Snapshot, ItemAttribute, ParsedFile]
+    The auction and buyout metrics cover auctions that started in the
+    period, ``ended_count`` the ones that ended in it and ``won_count`` the
+    ones that ended in it with a WON_* estimated result. Realm groups are
+    kept apart so that their imports never update the same rows, readers
+    sum them up as needed.
+    """
+    realm_key           = CharField(null=True)
+    item_id             = IntegerField()
+    period              = CharField()
+    period_start        = DateTimeField()
+
+    auction_count       = IntegerField(default=0)
+    quantity_sum        = IntegerField(default=0)
+    quantity_max        = IntegerField(null=True)
+    buyout_count        = IntegerField(default=0)
+    buyout_quantity_sum = IntegerField(default=0)
+    buyout_quantity_max = IntegerField(null=True)
+    buyout_sum          = BigIntegerField(default=0)
+    buyout_ppi_sum      = FloatField(default=0)
+    buyout_ppi_min      = FloatField(null=True)
+    buyout_ppi_max      = FloatField(null=True)
+    ended_count         = IntegerField(default=0)
+    won_count           = IntegerField(default=0)
+
+    class Meta(GlobalMeta):
+        indexes         = (
+            (('realm_key', 'item_id', 'period', 'period_start'), True),
+            (('item_id', 'period', 'period_start'), False),
+            (('period', 'period_start'), False),
+        )
+
+    PERIODS             = ['hour', 'day']
+    METRICS             = [
+        'auction_count', 'quantity_sum', 'quantity_max',
+        'buyout_count', 'buyout_quantity_sum', 'buyout_quantity_max',
+        'buyout_sum', 'buyout_ppi_sum', 'buyout_ppi_min', 'buyout_ppi_max',
+        'ended_count', 'won_count',
+    ]
+    # column order of the rows add_deltas() hands to BulkWriter
+    ROW_COLUMNS         = ['realm_key', 'item_id', 'period', 'period_start'] + METRICS
+
+    @classmethod
+    def get_period_start(cls, period, ts):
+        if period == 'hour':
+            return ts.replace(minute=0, second=0, microsecond=0)
+        elif period == 'day':
+            return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+        raise ValueError('Unknown period: %s' % period)
+
+    @classmethod
+    def merge_metric(cls, metric, a, b):
+        if metric.endswith('_max') or metric.endswith('_min'):
+            values = [v for v in (a, b) if v is not None]
+            if not values:
+                return None
+            return max(values) if metric.endswith('_max') else min(values)
+        return (a or 0) + (b or 0)
+
+    @classmethod
+    def add_deltas(cls, deltas, ts, realm_key=None):
+        """Fold ``{item_id: {metric: value}}`` into the realm group's buckets holding ``ts``."""
+        db = cls._meta.database
+        update_sql = 'UPDATE {0}{1}{0} SET {2} WHERE id = {3}'.format(
+            db.quote_char, cls._meta.db_table,
+            ', '.join('{0}{1}{0} = {2}'.format(db.quote_char, m, db.interpolation) \
+                for m in cls.METRICS),
+            db.interpolation)
+        for period in cls.PERIODS:
+            period_start = cls.get_period_start(period, ts)
+            existing = dict((s.item_id, s) for s in cls.select().where(
+                (cls.realm_key == realm_key) &
+                (cls.period == period) & (cls.period_start == period_start)))
+            updates = []
+            for item_id, delta in deltas.iteritems():
+                stats = existing.get(item_id)
+                if stats is None:
+                    BULK_WRITER.write(cls._meta.db_table, cls.ROW_COLUMNS,
+                        [(realm_key, item_id, period, period_start) + tuple(
+                            cls.merge_metric(m, cls._meta.fields[m].default, delta.get(m)) \
+                                for m in cls.METRICS)])
+                else:
+                    updates.append(tuple(
+                        cls.merge_metric(m, getattr(stats, m), delta.get(m)) \
+                            for m in cls.METRICS) + (stats.id,))
+            if updates:
+                db.get_cursor().executemany(update_sql, updates)
+                QUERY_COUNTER.add()
+        BULK_WRITER.flush()
+
+class QuantileSketch(object):
+    """Mergeable quantile sketch with relative accuracy (DDSketch style).
+
+    Positive values are counted in logarithmically sized bins, so any
+    quantile comes back within ``relative_accuracy`` of the true value and
+    merging two sketches is just adding up their bin counts.
+    """
+    def __init__(self, relative_accuracy=0.01, bins=None):
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.bins = collections.defaultdict(int, bins or {})
+        self.count = sum(self.bins.itervalues())
+
+    def add(self, value, count=1):
+        if value <= 0:
+            raise ValueError('Only positive values can be added: %r' % value)
+        self.bins[int(math.ceil(math.log(value) / self._log_gamma))] += count
+        self.count += count
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Can not merge sketches with different accuracies')
+        for k, c in other.bins.iteritems():
+            self.bins[k] += c
+        self.count += other.count
+        return self
+
+    def quantile(self, q):
+        """Value at 0-based rank ``int(count * q)``, like ORDER BY ... OFFSET."""
+        if not self.count:
+            raise ValueError('Empty sketch')
+        rank = min(int(self.count * q), self.count - 1)
+        seen = 0
+        for k in sorted(self.bins):
+            seen += self.bins[k]
+            if seen > rank:
+                return 2 * self._gamma ** k / (self._gamma + 1)
+
+    def dumps(self):
+        return json.dumps([self.relative_accuracy, sorted(self.bins.iteritems())])
+
+    @classmethod
+    def loads(cls, value):
+        relative_accuracy, bins = json.loads(value)
+        return cls(relative_accuracy, dict((k, c) for k, c in bins))
+
+class PriceSketch(DataModel):
+    """Hourly per realm group, per item, per stack size sketch of buyout price per item."""
+    realm_key           = CharField(null=True)
+    item_id             = IntegerField()
+    quantity            = IntegerField()
+    period_start        = DateTimeField()
+    count               = IntegerField()
+    sketch              = TextField()
+
+    class Meta(GlobalMeta):
+        indexes         = (
+            (('realm_key', 'item_id', 'quantity', 'period_start'), True),
+            (('item_id', 'quantity', 'period_start'), False),
+            (('period_start',), False),
+        )
+
+    # column order of the rows add_prices() hands to BulkWriter
+    ROW_COLUMNS         = ['realm_key', 'item_id', 'quantity', 'period_start', 'count', 'sketch']
+
+    @classmethod
+    def add_prices(cls, prices, ts, realm_key=None):
+        """Fold ``{(item_id, quantity): [buyout per item, ...]}`` into the realm
+        group's hour holding ``ts``."""
+        period_start = ItemStats.get_period_start('hour', ts)
+        existing = dict(((s.item_id, s.quantity), s) for s in cls.select().where(
+            (cls.realm_key == realm_key) & (cls.period_start == period_start)))
+        for key, values in prices.iteritems():
+            stats = existing.get(key)
+            sketch = QuantileSketch() if stats is None else QuantileSketch.loads(stats.sketch)
+            for v in values:
+                sketch.add(v)
+            if stats is None:
+                BULK_WRITER.write(cls._meta.db_table, cls.ROW_COLUMNS,
+                    [(realm_key,) + key + (period_start, sketch.count, sketch.dumps())])
+            else:
+                cls.update(count=sketch.count, sketch=sketch.dumps()).where(
+                    cls.id == stats.id).execute()
+        BULK_WRITER.flush()
+
+    @classmethod
+    def load_window(cls, start, end=None, item_ids=None):
+        """Merge the hourly sketches from ``start`` to ``end``, of every realm group.
+
+        Returns ``{item_id: {quantity: QuantileSketch}}``.
+        """
+        where = cls.period_start >= ItemStats.get_period_start('hour', start)
+        if end is not None:
+            where &= cls.period_start <= end
+        if item_ids is not None:
+            where &= cls.item_id << list(item_ids)
+        sketches = collections.defaultdict(dict)
+        for item_id, quantity, value in cls.select(
+                cls.item_id, cls.quantity, cls.sketch).where(where).tuples():
+            sketch = QuantileSketch.loads(value)
+            if quantity in sketches[item_id]:
+                sketches[item_id][quantity].merge(sketch)
+            else:
+                sketches[item_id][quantity] = sketch
+        return sketches
+
+    @classmethod
+    def merge_quantities(cls, sketches, min_quantity=None, max_quantity=None):
+        """Merge one item's per quantity sketches with ``min < quantity < max``."""
+        merged = QuantileSketch()
+        for quantity, sketch in sketches.iteritems():
+            if (min_quantity is None or quantity > min_quantity) and \
+                    (max_quantity is None or quantity < max_quantity):
+                merged.merge(sketch)
+        return merged
+
+class ItemInfo(DataModel):
+    item_id             = IntegerField(primary_key=True)
+    # None if the lookup did not find a name
+    name                = CharField(null=True)
+    fetched_at          = DateTimeField(default=datetime.datetime.utcnow)
+
+MODELS = [AttributeKey, AttributeSet, AttributeSetMember, Auction, Snapshot, ItemAttribute,
+    ParsedFile, ItemStats, PriceSketch, ItemInfo]
+# unique indexes that now include the realm key, see drop_obsolete_indexes()
+OBSOLETE_UNIQUE_INDEXES = [
+    (ParsedFile,        ('timestamp',)),
+    (ItemStats,         ('item_id', 'period', 'period_start')),
+    (PriceSketch,       ('item_id', 'quantity', 'period_start')),
+]
+
+class AttributeSetCache(object):
+    """Maps AuctionRecord.attrs to AttributeSet IDs, creating missing sets.
+
+    Every key and set digest is loaded on first use, there are few enough
+    distinct sets for that to be cheap. Call reset() if a transaction that
+    created sets is rolled back. Other processes (see RealmImporter) may
+    create the same sets in the meantime, those are picked up on conflict.
+    """
+    def __init__(self):
+        self._keys = None
+        self._sets = None
+        self.created_count = 0
+
+    def get_id(self, attrs):
+        if not attrs:
+            return None
+        if self._sets is None:
+            self._load()
+        digest = AttributeSet.get_digest(attrs)
+        set_id = self._sets.get(digest)
+        if set_id is None:
+            set_id = self._sets[digest] = self._create(digest, attrs)
+        return set_id
+
+    def reset(self):
+        self._keys = None
+        self._sets = None
+
+    def _load(self):
+        self._keys = dict(AttributeKey.select(AttributeKey.name, AttributeKey.id).tuples())
+        self._sets = dict(AttributeSet.select(AttributeSet.digest, AttributeSet.id).tuples())
+        logger.debug('Loaded attribute sets: %d', len(self._sets))
+
+    def _get_key_id(self, name):
+        key_id = self._keys.get(name)
+        if key_id is None:
+            try:
+                # a savepoint, so that a conflict only rolls back this insert
+                with GlobalMeta.database.atomic():
+                    key_id = AttributeKey.create(name=name).id
+            except IntegrityError:
+                key_id = AttributeKey.get(AttributeKey.name == name).id
+            self._keys[name] = key_id
+        return key_id
+
+    def _create(self, digest, attrs):
+        try:
+            with GlobalMeta.database.atomic():
+                attr_set = AttributeSet.create(digest=digest, size=len(attrs))
+                AttributeSetMember.insert_many([
+                    {'attr_set': attr_set.id, 'key': self._get_key_id(key), 'value': value}
+                    for key, value in attrs]).execute()
+        except IntegrityError:
+            # the keys created in the savepoint are gone as well
+            self._keys = dict(AttributeKey.select(AttributeKey.name, AttributeKey.id).tuples())
+            return AttributeSet.get(AttributeSet.digest == digest).id
+        self.created_count += 1
+        return attr_set.id
+
+class BulkWriter(object):
+    """Buffers plain row tuples per table and writes them in large batches.
+
+    Rows must be in the same order as the ``columns`` they are written with.
+    Buffered rows only reach the DB on :meth:`flush` (or when a buffer is
+    full), so callers should flush before committing.
+    """
+    def __init__(self, db, buffer_size=10000):
+        self._db = db
+        self._buffer_size = buffer_size
+        self._buffers = collections.OrderedDict()
+
+    def write(self, table, columns, rows):
+        buf = self._buffers.setdefault((table, tuple(columns)), [])
+        buf.extend(rows)
+        if len(buf) >= self._buffer_size:
+            self._write_rows(table, columns, buf)
+            del buf[:]
+
+    def flush(self):
+        for (table, columns), buf in self._buffers.iteritems():
+            if buf:
+                self._write_rows(table, columns, buf)
+                del buf[:]
+
+    def discard(self):
+        self._buffers.clear()
+
+    def _write_rows(self, table, columns, rows):
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            self._quote(table),
+            ', '.join(self._quote(c) for c in columns),
+            ', '.join([self._db.interpolation] * len(columns)))
+        self._db.get_cursor().executemany(sql, rows)
+        QUERY_COUNTER.add()
+
+    def _quote(self, name):
+        return '{0}{1}{0}'.format(self._db.quote_char, name)
+
+class ImportSqliteDatabase(SqliteDatabase):
+    """SqliteDatabase set up for bulk imports, used for ``sqlite://`` URLs.
+
+    The pragmas are set on every connection, reconnects included.
+    Transactions take the write lock when they start: concurrent writers
+    (see RealmImporter) then wait for each other, upgrading a read lock
+    later on fails right away if another writer got in between.
+    """
+    # trade some durability on power loss for much faster bulk writes
+    PRAGMAS             = [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('temp_store', 'MEMORY'),
+        ('cache_size', -64 * 1024),
+        # milliseconds to wait on another process' write lock
+        ('busy_timeout', 5 * 60 * 1000),
+    ]
+
+    def __init__(self, database, pragmas=None, *args, **kwargs):
+        super(ImportSqliteDatabase, self).__init__(database,
+            self.PRAGMAS + list(pragmas or []), *args, **kwargs)
+
+    def begin(self, lock_type='IMMEDIATE'):
+        super(ImportSqliteDatabase, self).begin(lock_type)
+
+register_database(ImportSqliteDatabase, 'sqlite')
+
+class PostgresqlBulkWriter(BulkWriter):
+    COPY_NULL           = '\\N'
+    RE_COPY_ESCAPE      = re.compile(r'[\\\t\n\r]')
+    COPY_ESCAPES        = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+
+    def _write_rows(self, table, columns, rows):
+        buf = io.BytesIO()
+        for row in rows:
+            buf.write(u'\t'.join(self._copy_value(v) for v in row).encode('utf-8'))
+            buf.write(b'\n')
+        buf.seek(0)
+        self._db.get_cursor().copy_from(buf, table, null=self.COPY_NULL, columns=columns)
+        QUERY_COUNTER.add()
+
+    def _copy_value(self, value):
+        if value is None:
+            return self.COPY_NULL
+        return self.RE_COPY_ESCAPE.sub(
+            lambda m: self.COPY_ESCAPES[m.group(0)], unicode(value))
+
+def get_bulk_writer(db):
+    if isinstance(db, PostgresqlDatabase):
+        return PostgresqlBulkWriter(db)
+    return BulkWriter(db)
+
+BULK_WRITER = Proxy()
+
+class QueryCounter(object):
+    """Counts the statements run on a database.
+
+    Everything that goes through ``db.execute_sql()`` is counted
+    automatically, callers using a cursor directly (executemany(), COPY)
+    call add() themselves.
+    """
+    def __init__(self, db):
+        self.count = 0
+        self._execute_sql = db.execute_sql
+        db.execute_sql = self._execute_counted
+
+    def add(self, n=1):
+        self.count += n
+
+    def _execute_counted(self, *args, **kwargs):
+        self.count += 1
+        return self._execute_sql(*args, **kwargs)
+
+QUERY_COUNTER = Proxy()
+
+# statements for PartitionManager.archive(), "?" is swapped for the database's
+# own parameter style before execution. Auctions are archived once they have
+# ended before the cutoff and their snapshots have been compacted.
+STMT_PARTITION_FIRST = """
+SELECT
+        min(started_at)
+    FROM {source}
+    WHERE
+        ended_at < ?
+        AND snapshot_count IS NOT NULL
+        AND NOT EXISTS (
+            SELECT
+                    1
+                FROM {item_attribute} i
+                WHERE i.auction_id = {auction}.id
+        )
+;
+"""
+STMT_PARTITION_PG_CREATE = """
+CREATE TABLE IF NOT EXISTS {partition} (
+        LIKE {auction} INCLUDING DEFAULTS INCLUDING INDEXES
+        , CHECK (started_at >= ? AND started_at < ? AND ended_at IS NOT NULL)
+    ) INHERITS ({auction})
+;
+"""
+STMT_PARTITION_PG_MOVE = """
+WITH moved AS (
+    DELETE FROM ONLY {auction}
+        WHERE
+            started_at >= ?
+            AND started_at < ?
+            AND ended_at < ?
+            AND snapshot_count IS NOT NULL
+            AND NOT EXISTS (
+                SELECT
+                        1
+                    FROM {item_attribute} i
+                    WHERE i.auction_id = {auction}.id
+            )
+        RETURNING *
+)
+INSERT INTO {partition}
+    SELECT
+            *
+        FROM moved
+;
+"""
+STMT_PARTITION_SQLITE_COPY = """
+INSERT INTO {partition} ({columns})
+    SELECT
+            {columns}
+        FROM main.{auction}
+        WHERE
+            started_at >= ?
+            AND started_at < ?
+            AND ended_at < ?
+            AND snapshot_count IS NOT NULL
+            AND NOT EXISTS (
+                SELECT
+                        1
+                    FROM {item_attribute} i
+                    WHERE i.auction_id = {auction}.id
+            )
+;
+"""
+STMT_PARTITION_SQLITE_DELETE = """
+DELETE FROM main.{auction}
+    WHERE
+        started_at >= ?
+        AND started_at < ?
+        AND ended_at < ?
+        AND snapshot_count IS NOT NULL
+        AND NOT EXISTS (
+            SELECT
+                    1
+                FROM {item_attribute} i
+                WHERE i.auction_id = {auction}.id
+        )
+;
+"""
+
+# auctions run for 48 hours at most
+MAX_AUCTION_DURATION = datetime.timedelta(days=2)
+
+class PartitionManager(object):
+    """Monthly (by ``started_at``) partitions of old auctions.
+
+    archive() moves auctions out of the ``auction`` table once they have
+    ended and their snapshots have been compacted, so the scans done by the
+    import only ever see recent rows. route() returns the table to query
+    for auctions that started in a time range, partitions included, and
+    select() points an Auction query at it.
+    """
+    def __init__(self, db):
+        self._db = db
+
+    def route(self, start, end):
+        return Auction._meta.db_table
+
+    def route_batches(self, start, end):
+        """Like route(), for time ranges that may have more partitions than
+        one query can use.
+
+        Returns a list of functions that each route a batch of them and
+        return the table to query. The batches do not overlap, and each
+        table is only valid until the next function is called.
+        """
+        return [functools.partial(self.route, start, end)]
+
+    def select(self, query, start, end):
+        table = self.route(start, end)
+        if table == Auction._meta.db_table:
+            return query
+        # the same alias the compiler gives the query's model
+        alias = self._db.compiler().calculate_alias_map(query)[Auction]
+        return query.from_(SQL('{0}{1}{0} AS {2}'.format(self._db.quote_char, table, alias)))
+
+    def months(self):
+        """First days of the months archived into a partition, oldest first."""
+        return []
+
+    def archive(self, cutoff):
+        # the snapshots are still compacted, the auctions just stay put
+        logger.warning('Partitions are not supported on %s, not archiving auctions',
+            type(self._db).__name__)
+
+    def _iter_archive_months(self, cutoff, source):
+        first = self._execute(STMT_PARTITION_FIRST, (cutoff,), source=source).fetchone()[0]
+        if first is None:
+            return []
+        return list(_iter_months(Auction.started_at.python_value(first), cutoff))
+
+    def _execute(self, stmt, params=None, **names):
+        names.setdefault('auction', Auction._meta.db_table)
+        names.setdefault('item_attribute', ItemAttribute._meta.db_table)
+        return self._db.execute_sql(
+            stmt.format(**names).replace('?', self._db.interpolation), params)
+
+class PostgresqlPartitionManager(PartitionManager):
+    """Partitions are child tables that inherit from ``auction``.
+
+    Their CHECK constraints let the planner skip the ones that can not
+    match a query (constraint exclusion), so every query against
+    ``auction`` is routed natively and route() has nothing to do.
+    """
+    def archive(self, cutoff):
+        source = 'ONLY {}'.format(Auction._meta.db_table)
+        for month in self._iter_archive_months(cutoff, source):
+            partition = '{}_p{}'.format(Auction._meta.db_table, month.strftime('%Y_%m'))
+            with self._db.atomic():
+                self._execute(STMT_PARTITION_PG_CREATE, (month, _next_month(month)),
+                    partition=partition)
+                c = self._execute(STMT_PARTITION_PG_MOVE, (month, _next_month(month), cutoff),
+                    partition=partition)
+            logger.info('Archived auctions into %s: %d', partition, c.rowcount)
+
+class SqlitePartitionManager(PartitionManager):
+    """Partitions are per month database files next to the main one.
+
+    route() ATTACHes the partitions a query needs and puts them behind a
+    temporary UNION ALL view, up to MAX_ATTACHED of them at a time (see
+    route_batches()). SQLite can not ATTACH or DETACH inside a transaction,
+    so neither route() nor archive() may be called in one.
+    """
+    # SQLITE_MAX_ATTACHED defaults to 10
+    MAX_ATTACHED        = 10
+    VIEW_NAME           = 'auction_routed'
+    RE_CREATE           = re.compile(r'^(CREATE (?:UNIQUE )?(?:TABLE|INDEX) (?:IF NOT EXISTS )?)', re.I)
+
+    def __init__(self, db):
+        super(SqlitePartitionManager, self).__init__(db)
+        self._attached = set()
+
+    def route(self, start, end):
+        months = self._get_months(start, end)
+        if len(months) > self.MAX_ATTACHED:
+            raise ValueError('Too many partitions for one query: %d' % len(months))
+        return self._route(months)
+
+    def route_batches(self, start, end):
+        months = self._get_months(start, end)
+        # only the first batch includes the main table
+        return [functools.partial(self._route, months[i:i + self.MAX_ATTACHED], main=(i == 0)) \
+            for i in range(0, max(len(months), 1), self.MAX_ATTACHED)]
+
+    def _route(self, months, main=True):
+        self._db.execute_sql('DROP VIEW IF EXISTS temp.{}'.format(self.VIEW_NAME))
+        self._detach_all(keep=set(self._get_schema(m) for m in months))
+        if main and not months:
+            return Auction._meta.db_table
+        columns = ', '.join(f.db_column for f in Auction._meta.sorted_fields)
+        self._db.execute_sql('CREATE TEMP VIEW {} AS {}'.format(self.VIEW_NAME, ' UNION ALL '.join(
+            'SELECT {} FROM {}.{}'.format(columns, schema, Auction._meta.db_table) \
+                for schema in (['main'] if main else []) + [self._attach(m) for m in months])))
+        return self.VIEW_NAME
+
+    def archive(self, cutoff):
+        if self._get_path(cutoff) is None:
+            raise ValueError('Partitions need an on disk database')
+        self._db.execute_sql('DROP VIEW IF EXISTS temp.{}'.format(self.VIEW_NAME))
+        columns = ', '.join(f.db_column for f in Auction._meta.sorted_fields)
+        source = 'main.{}'.format(Auction._meta.db_table)
+        for month in self._iter_archive_months(cutoff, source):
+            self._detach_all()
+            partition = '{}.{}'.format(self._attach(month, create=True), Auction._meta.db_table)
+            with self._db.atomic():
+                c = self._execute(STMT_PARTITION_SQLITE_COPY, (month, _next_month(month), cutoff),
+                    partition=partition, columns=columns)
+                self._execute(STMT_PARTITION_SQLITE_DELETE, (month, _next_month(month), cutoff))
+            logger.info('Archived auctions into %s: %d', self._get_path(month), c.rowcount)
+        self._detach_all()
+
+    def months(self):
+        if self._db.database == ':memory:':
+            return []
+        months = []
+        prefix = '{}-{}-'.format(os.path.splitext(self._db.database)[0], Auction._meta.db_table)
+        for fn in glob.glob(prefix + '*.db'):
+            try:
+                months.append(datetime.datetime.strptime(fn[len(prefix):-len('.db')], '%Y-%m'))
+            except ValueError:
+                continue
+        return sorted(months)
+
+    def _get_months(self, start, end):
+        return [m for m in _iter_months(start, end) if os.path.exists(self._get_path(m))]
+
+    def _get_path(self, month):
+        if self._db.database == ':memory:':
+            return None
+        return '{}-{}-{}.db'.format(os.path.splitext(self._db.database)[0],
+            Auction._meta.db_table, month.strftime('%Y-%m'))
+
+    def _get_schema(self, month):
+        return month.strftime('p%Y_%m')
+
+    def _attach(self, month, create=False):
+        schema = self._get_schema(month)
+        if schema not in self._attached:
+            self._db.execute_sql('ATTACH DATABASE ? AS {}'.format(schema), (self._get_path(month),))
+            self._attached.add(schema)
+            self._add_missing_columns(schema)
+        if create and not self._db.execute_sql(
+                'SELECT count(*) FROM {}.sqlite_master WHERE name = ?'.format(schema),
+                (Auction._meta.db_table,)).fetchone()[0]:
+            # same table and indexes as the main DB, "table" sorts before "index"
+            for (sql,) in self._db.execute_sql(
+                    'SELECT sql FROM main.sqlite_master WHERE tbl_name = ? AND sql IS NOT NULL '
+                    'ORDER BY type DESC', (Auction._meta.db_table,)).fetchall():
+                self._db.execute_sql(self.RE_CREATE.sub(r'\g<1>{}.'.format(schema), sql, count=1))
+        return schema
+
+    def _add_missing_columns(self, schema):
+        """Add the Auction columns declared after the partition was created."""
+        table = Auction._meta.db_table
+        existing = set(row[1] for row in self._db.execute_sql(
+            'PRAGMA {}.table_info("{}")'.format(schema, table)).fetchall())
+        compiler = self._db.compiler()
+        for field in Auction._meta.sorted_fields:
+            if existing and field.db_column not in existing:
+                logger.info('Adding column to %s.%s: %s', schema, table, field.db_column)
+                sql, params = compiler.parse_node(compiler.field_definition(field))
+                self._db.execute_sql('ALTER TABLE {}.{} ADD COLUMN {}'.format(schema, table, sql),
+                    params)
+
+    def _detach_all(self, keep=()):
+        for schema in self._attached - set(keep):
+            self._db.execute_sql('DETACH DATABASE {}'.format(schema))
+            self._attached.discard(schema)
+
+def get_partition_manager(db):
+    if isinstance(db, PostgresqlDatabase):
+        return PostgresqlPartitionManager(db)
+    elif isinstance(db, SqliteDatabase):
+        return SqlitePartitionManager(db)
+    return PartitionManager(db)
+
+PARTITIONS = Proxy()
 
 def db_connect(db_url, meta_model=GlobalMeta):
     db = db_url_connect(db_url)
+    QUERY_COUNTER.initialize(QueryCounter(db))
     meta_model.database.initialize(db)
     meta_model.database.create_tables(MODELS, safe=True)
+    create_missing_columns(db, MODELS)
+    drop_obsolete_indexes(db, OBSOLETE_UNIQUE_INDEXES)
+    create_missing_indexes(db, MODELS)
+    BULK_WRITER.initialize(get_bulk_writer(db))
+    PARTITIONS.initialize(get_partition_manager(db))
     return db
 
+def create_missing_columns(db, models):
+    """Add (nullable) columns that were declared after a table was created."""
+    migrator = SchemaMigrator.from_database(db)
+    for model in models:
+        table = model._meta.db_table
+        existing = set(c.name for c in db.get_columns(table))
+        for field in model._meta.sorted_fields:
+            if field.db_column not in existing:
+                logger.info('Adding column to %s: %s', table, field.db_column)
+                # add_column() renames the field it is given, so hand it a copy
+                migrate(migrator.add_column(table, field.db_column, field.clone_base()))
+
+def drop_obsolete_indexes(db, indexes):
+    """Drop unique indexes that are no longer unique.
+
+    They are recreated as plain indexes by create_missing_indexes(), if
+    still declared.
+    """
+    compiler = db.compiler()
+    for model, field_names in indexes:
+        table = model._meta.db_table
+        name = compiler.index_name(table, [model._meta.fields[f].db_column for f in field_names])
+        if any(i.name == name and i.unique for i in db.get_indexes(table)):
+            logger.info('Dropping unique index on %s: %s', table, ', '.join(field_names))
+            db.drop_index(model, list(field_names))
+
+def create_missing_indexes(db, models):
+    """Add indexes that were declared after a table was created.
+
+    create_tables(safe=True) skips tables that already exist entirely,
+    indexes included.
+    """
+    compiler = db.compiler()
+    for model in models:
+        table = model._meta.db_table
+        existing = set(i.name for i in db.get_indexes(table))
+        index_data = [((f.name,), f.unique) for f in model._fields_to_index()]
+        for field_names, unique in index_data + list(model._meta.indexes or ()):
+            fields = [model._meta.fields[f] for f in field_names]
+            if compiler.index_name(table, [f.db_column for f in fields]) not in existing:
+                logger.info('Creating index on %s: %s', table, ', '.join(field_names))
+                db.create_index(model, fields, unique)
+
+class AuctionRecord(collections.namedtuple('AuctionRecord', sorted(Auction.KEY_MAP) + [
+        'bid', 'time_left', 'attrs'])):
+    """Cleaned auction from a dump, as produced by DataSource.
+
+    A tuple is a fraction of the size of the JSON dict it is made from, and
+    ``attrs`` holds the item attribute (key, value) pairs so the dict can be
+    dropped as soon as the record exists.
+    """
+    __slots__           = ()
+
+class ImportStats(object):
+    """Timings (in seconds) and counters for the import of one dump.
+
+    DataSource fills in the loading phases, in a worker process if need be,
+    and DataManager.import_data() the rest before passing it to its sinks.
+    """
+    def __init__(self):
+        self.timings = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def add_time(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+class MetricsSink(object):
+    """Receives the ImportStats of every dump imported by a DataManager."""
+    def write(self, ts, realm_key, stats):
+        raise NotImplementedError()
+
+class JsonLinesSink(MetricsSink):
+    """Appends one JSON object per imported dump to a file."""
+    def __init__(self, path):
+        self._path = path
+
+    def write(self, ts, realm_key, stats):
+        line = json.dumps(collections.OrderedDict([
+            ('timestamp',   ts.isoformat()),
+            ('realm_key',   realm_key),
+            ('imported_at', datetime.datetime.utcnow().isoformat()),
+            ('timings',     stats.timings),
+            ('counters',    stats.counters),
+        ]))
+        with open(self._path, 'a') as handle:
+            handle.write(line + '\n')
+
+class PrometheusTextfileSink(MetricsSink):
+    """Keeps a file for node_exporter's textfile collector up to date.
+
+    The gauges describe the last dump imported for each realm, the file is
+    replaced atomically so the collector never sees a partial write.
+    """
+    RE_LABEL_ESCAPE     = re.compile(r'[\\"\n]')
+    LABEL_ESCAPES       = {'\\': '\\\\', '"': '\\"', '\n': '\\n'}
+
+    def __init__(self, path, prefix='wowah_import'):
+        self._path = path
+        self._prefix = prefix
+        # realm_key -> (ts, stats) of the last dump
+        self._last = collections.OrderedDict()
+
+    def write(self, ts, realm_key, stats):
+        self._last[realm_key] = (ts, stats)
+        lines = []
+        self._add_metric(lines, 'dump_timestamp_seconds',
+            'Timestamp of the last imported dump.',
+            [({'realm_key': k}, calendar.timegm(ts.utctimetuple())) \
+                for k, (ts, _) in self._last.iteritems()])
+        self._add_metric(lines, 'phase_seconds',
+            'Time spent in each phase of the last imported dump.',
+            [({'realm_key': k, 'phase': name}, value) \
+                for k, (_, s) in self._last.iteritems() for name, value in s.timings.iteritems()])
+        self._add_metric(lines, 'count',
+            'Rows, queries and bytes counted for the last imported dump.',
+            [({'realm_key': k, 'counter': name}, value) \
+                for k, (_, s) in self._last.iteritems() for name, value in s.counters.iteritems()])
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as handle:
+            handle.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, self._path)
+
+    def _add_metric(self, lines, name, help_text, samples):
+        name = '{}_{}'.format(self._prefix, name)
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} gauge'.format(name))
+        for labels, value in samples:
+            lines.append('{}{{{}}} {}'.format(name, ','.join(
+                '{}="{}"'.format(k, self._escape(v)) for k, v in sorted(labels.iteritems())),
+                repr(float(value))))
+
+    def _escape(self, value):
+        return self.RE_LABEL_ESCAPE.sub(lambda m: self.LABEL_ESCAPES[m.group(0)], value)
+
+class QueueSink(MetricsSink):
+    """Passes the ImportStats on to another process, see RealmImporter."""
+    def __init__(self, queue):
+        self._queue = queue
+
+    def write(self, ts, realm_key, stats):
+        self._queue.put((ts, realm_key, stats))
+
+class DumpStream(object):
+    """Incremental reader for the top level keys of a dump file.
+
+    Only as much of the (decompressed) file as is needed to decode the next
+    value is held in memory, so arrays like ``auctions`` can be walked one
+    element at a time.
+    """
+    RE_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, handle, chunk_size=64 * 1024):
+        self._handle = handle
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = u''
+        self._pos = 0
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+
+    def _fill(self):
+        start = time.time()
+        chunk = self._handle.read(self._chunk_size)
+        self.read_seconds += time.time() - start
+        self.bytes_read += len(chunk)
+        text = self._text_decoder.decode(chunk, final=not chunk)
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+        return bool(chunk)
+
+    def _skip_whitespace(self):
+        while True:
+            self._pos = self.RE_WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf) or not self._fill():
+                return
+
+    def _expect(self, token):
+        self._skip_whitespace()
+        if not self._buf.startswith(token, self._pos):
+            raise ValueError('Expected %r at offset %d' % (token, self.bytes_read))
+        self._pos += len(token)
+
+    def _decode_value(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                # most likely the value is split across chunks
+                if not self._fill():
+                    raise
+            else:
+                self._pos = end
+                return value
+
+    def seek_key(self, key, before=None):
+        """Position the stream at the value for the top level ``key``.
+
+        If ``before`` is given and that key shows up first, a ValueError is
+        raised rather than scanning past it.
+        """
+        needle = u'"%s"' % key
+        stop = None if before is None else u'"%s"' % before
+        while True:
+            idx = self._buf.find(needle, self._pos)
+            stop_idx = -1 if stop is None else self._buf.find(stop, self._pos)
+            if stop_idx >= 0 and (idx < 0 or stop_idx < idx):
+                raise ValueError('Found key "%s" before "%s"' % (before, key))
+            if idx >= 0:
+                self._pos = idx + len(needle)
+                self._expect(u':')
+                return
+            # keep a tail in case the key straddles the chunk boundary
+            keep = max(len(needle), 0 if stop is None else len(stop))
+            self._pos = max(self._pos, len(self._buf) - keep)
+            if not self._fill():
+                raise ValueError('Key not found: %s' % key)
+
+    def read_key(self, key, before=None):
+        self.seek_key(key, before=before)
+        return self._decode_value()
+
+    def iter_array(self, key):
+        self.seek_key(key)
+        self._expect(u'[')
+        self._skip_whitespace()
+        if self._buf.startswith(u']', self._pos):
+            self._pos += 1
+            return
+        while True:
+            yield self._decode_value()
+            self._skip_whitespace()
+            if self._buf.startswith(u',', self._pos):
+                self._pos += 1
+            elif self._buf.startswith(u']', self._pos):
+                self._pos += 1
+                return
+            else:
+                raise ValueError('Malformed array at offset %d' % self.bytes_read)
+
 class DataSource(object):
     RE_DATA_FN = re.compile(r'auctions-(?P<ts>[0-9]{13})-(?P<hash>[0-9a-f]{32})\.json(?:\.bz2)?')
 
-    def __init__(self, path, skip_before=0):
+    def __init__(self, path, skip_before=0, streaming=False, workers=0, prefetch=None,
+            realm_hashes=None):
+        if streaming and workers:
+            raise ValueError('Streaming can not be combined with worker processes')
         self._skip_before = datetime.datetime.utcfromtimestamp(skip_before)
         self._path = path.rstrip('/')
+        self._streaming = streaming
+        self._workers = workers
+        self._prefetch = prefetch if prefetch is not None else workers
+        # only read the dumps of these realm groups (filename hashes)
+        self._realm_hashes = None if realm_hashes is None else set(realm_hashes)
+        # realm hash -> timestamp of the last dump to skip, see resume()
+        self._last_ts = {}
+
+    def resume(self):
+        """Skip the dumps up to the last one imported, for each realm group."""
+        self._last_ts = get_last_timestamps()
+        return self
+
+    def get_realm_hashes(self):
+        """The realm hashes of the dumps to read, largest total size first."""
+        sizes = collections.Counter()
+        for data_filename, _, realm_hash in self._iter_data_files():
+            sizes[realm_hash] += os.path.getsize(data_filename)
+        return [h for h, _ in sizes.most_common()]
 
     def __iter__(self):
+        if self._workers:
+            return self._iter_parallel()
+        return self._iter_serial()
+
+    def mark_failed(self, data):
+        """Called by DataManager.import_data() for a dump that failed to import."""
+        pass
+
+    def _iter_data_files(self):
         # auctions-1478015194000-e02305572b12efe069bed00ba1106f77.json.bz2
         for data_filename in self._get_data_files():
             dump_ts, realm_hash = self._parse_fn(data_filename)
-            if dump_ts <= self._skip_before:
+            if self._is_skipped(dump_ts, realm_hash):
                 logger.debug('Skipping file: %s', data_filename)
                 continue
-            logger.info('Reading from: %s', data_filename)
-            logger.debug('Using timestamp: %s', dump_ts)
+            yield (data_filename, dump_ts, realm_hash)
+
+    def _is_skipped(self, dump_ts, realm_hash):
+        if self._realm_hashes is not None and realm_hash not in self._realm_hashes:
+            return True
+        return dump_ts <= max(self._skip_before, self._last_ts.get(realm_hash, self._skip_before))
+
+    def _iter_serial(self):
+        for data_filename, dump_ts, realm_hash in self._iter_data_files():
+            data = self._load_file(data_filename, dump_ts, realm_hash)
+            if data is not None:
+                yield data
+
+    def _load_file(self, data_filename, dump_ts, realm_hash):
+        if not self._streaming:
+            return _load_data_file(self, data_filename, dump_ts, realm_hash)
+        logger.info('Reading from: %s', data_filename)
+        logger.debug('Using timestamp: %s', dump_ts)
+        try:
+            return self._stream_data(data_filename, dump_ts, realm_hash)
+        except Exception as err:
+            logger.exception(err)
+            return None
+
+    def _iter_parallel(self):
+        """Decompress, parse and clean upcoming files in worker processes.
+
+        At most ``prefetch`` files are in flight (or waiting to be consumed)
+        at any time, and results are always handed out in filename (and so
+        timestamp) order.
+        """
+        pool = multiprocessing.Pool(self._workers)
+        pending = collections.deque()
+        try:
+            for args in self._iter_data_files():
+                pending.append(pool.apply_async(_load_data_file, (self,) + args))
+                if len(pending) > self._prefetch:
+                    data = self._wait(pending.popleft())
+                    if data is not None:
+                        yield data
+            while pending:
+                data = self._wait(pending.popleft())
+                if data is not None:
+                    yield data
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _wait(self, result):
+        start = time.time()
+        data = result.get()
+        if data is not None:
+            # time the import was stalled waiting on the workers
+            data['stats'].add_time('load_wait', time.time() - start)
+        return data
+
+    def _load_data(self, data_filename, ts, realm_hash):
+        logger.info('Reading from: %s', data_filename)
+        logger.debug('Using timestamp: %s', ts)
+        stats = ImportStats()
+        stats.count('bytes_compressed', os.path.getsize(data_filename))
+        with stats.phase('decompress'):
             with bz2.BZ2File(data_filename, 'r') as data_handle:
-                try:
-                    data = json.load(data_handle)
-                except Exception as err:
-                    logger.exception(err)
-                    continue
-            logger.debug('Found %06d auctions...', len(data['auctions']))
-            yield self._clean_data(data, dump_ts, realm_hash)
+                raw = data_handle.read()
+        stats.count('bytes_read', len(raw))
+        # json.load() reads the whole file before parsing it as well
+        with stats.phase('parse'):
+            data = json.loads(raw)
+        del raw
+        logger.debug('Found %06d auctions...', len(data['auctions']))
+        with stats.phase('clean'):
+            data = self._clean_data(data, data_filename, ts, realm_hash)
+        data['stats'] = stats
+        return data
+
+    def _stream_data(self, data_filename, ts, realm_hash):
+        """Read the dump header eagerly and the auctions lazily.
+
+        The returned dict has the same keys as :meth:`_clean_data` but
+        ``auctions`` is a generator of AuctionRecords that reads the file
+        as it is consumed, so it can only be iterated once. Parsing and
+        cleaning then happen within the import phases, only the time spent
+        decompressing is known.
+        """
+        stats = ImportStats()
+        stats.count('bytes_compressed', os.path.getsize(data_filename))
+        data_handle = bz2.BZ2File(data_filename, 'r')
+        try:
+            stream = DumpStream(data_handle)
+            data = {'realms': stream.read_key('realms', before='auctions')}
+        except Exception:
+            data_handle.close()
+            raise
+        realms = self._get_realm_map(data)
+
+        def iter_auctions():
+            try:
+                for a in stream.iter_array('auctions'):
+                    yield self._clean_auction(a, realms)
+            finally:
+                data_handle.close()
+                stats.add_time('decompress', stream.read_seconds)
+                stats.count('bytes_read', stream.bytes_read)
+            logger.debug('Read %d bytes from: %s', stream.bytes_read, data_filename)
 
-    def _clean_data(self, data, ts, realm_hash):
+        data['auctions'] = iter_auctions()
+        data['stats'] = stats
+        return self._set_dump_meta(data, data_filename, ts, realm_hash, realms)
+
+    def _clean_data(self, data, data_filename, ts, realm_hash):
         logger.debug('Pre-processing dump data...')
-        realms = {r['name']: r['slug'] for r in data['realms']}
-        for a in tqdm(data['auctions'], disable=OPTION_DISABLE_PROGRESS_BAR):
-            if a['owner'] == '???':
-                a['owner'] = None
-            a['ownerRealm'] = realms.get(a['ownerRealm'])
-            if a['buyout'] == 0:
-                a['buyout'] = None
-            a['timeLeft'] = Snapshot.TIME_LEFT_ENUM[a['timeLeft']]
+        realms = self._get_realm_map(data)
+        auctions = data['auctions']
+        # replaced in place so each dict can be freed as soon as it is converted
+        for i in tqdm(range(len(auctions)), disable=OPTION_DISABLE_PROGRESS_BAR):
+            auctions[i] = self._clean_auction(auctions[i], realms)
+        return self._set_dump_meta(data, data_filename, ts, realm_hash, realms)
+
+    def _get_realm_map(self, data):
+        return {r['name']: r['slug'] for r in data['realms']}
+
+    def _clean_auction(self, a, realms):
+        if a['owner'] == '???':
+            a['owner'] = None
+        a['ownerRealm'] = realms.get(a['ownerRealm'])
+        if a['buyout'] == 0:
+            a['buyout'] = None
+        a['timeLeft'] = Snapshot.TIME_LEFT_ENUM[a['timeLeft']]
+        record = dict((k, a[v]) for k, v in Auction.KEY_MAP.iteritems())
+        return AuctionRecord(bid=a['bid'], time_left=a['timeLeft'],
+            attrs=tuple(ItemAttribute._iter_attributes(a)), **record)
+
+    def _set_dump_meta(self, data, data_filename, ts, realm_hash, realms):
+        data['filename'] = data_filename
         data['timestamp'] = ts
         data['realm_hash'] = realm_hash
         data['realm_key'] = '+'.join(sorted(realms.values()))
@@ -296,88 +1536,1681 @@ class DataSource(object):
         else:
             raise ValueError('Unable to parse filename: %s' % fn)
 
+class DataWatcher(DataSource):
+    """DataSource that waits for new dumps instead of stopping at the last one.
+
+    Only dumps newer than ``skip_before`` are read, by default the last
+    ParsedFile timestamp of their realm group, so a restart resumes without
+    opening (or looking up) any of the older files. Dump filenames sort by
+    their timestamp, so the older ones are passed over with a string
+    comparison against the earliest resume point of the realm groups
+    (without parsing them). Realm groups that have no dumps imported yet
+    only get the dumps after that point. New files are noticed
+    through inotify when pyinotify is installed, otherwise by polling the
+    directory every ``poll_interval`` seconds. Files that were not reported
+    as complete by inotify are only read once they are ``settle_time``
+    seconds old. A dump that fails to load is retried once it changes, the
+    later dumps of its realm group wait for it until then.
+    """
+    def __init__(self, path, skip_before=None, streaming=False, poll_interval=1.0,
+            settle_time=2.0, realm_hashes=None):
+        super(DataWatcher, self).__init__(path, skip_before or 0, streaming=streaming,
+            realm_hashes=realm_hashes)
+        if skip_before is None:
+            self.resume()
+        self._poll_interval = poll_interval
+        self._settle_time = settle_time
+        self._notifier = None
+        self._dir_mtime = None
+        # candidate filenames, and the ones inotify reported as complete
+        self._pending = set()
+        self._closed = set()
+        # filename -> mtime of the dumps that failed to load
+        self._failed = {}
+
+    def __iter__(self):
+        logger.info('Watching %s for new dumps', self._path)
+        if pyinotify is not None:
+            self._start_notifier()
+        self._pending.update(self._list_new_files())
+        while True:
+            blocked = set()
+            for data_filename, dump_ts, realm_hash in self._take_ready_files():
+                if realm_hash in blocked:
+                    self._pending.add(data_filename)
+                    continue
+                data = self._load_file(data_filename, dump_ts, realm_hash)
+                if data is None:
+                    self._set_failed(data_filename)
+                    blocked.add(realm_hash)
+                    continue
+                self._failed.pop(data_filename, None)
+                yield data
+                if data_filename in self._failed:
+                    # see mark_failed()
+                    blocked.add(realm_hash)
+                    continue
+                self._last_ts[realm_hash] = dump_ts
+            self._wait_for_files()
+
+    def mark_failed(self, data):
+        """Retry a dump that failed to import once it changes, like one that
+        failed to load.
+        """
+        self._set_failed(data['filename'])
+
+    def _take_ready_files(self):
+        """Remove the pending dumps that can be read now and return them, in order."""
+        ready = []
+        # realm hashes waiting on a dump that failed to load
+        blocked = set()
+        for data_filename in sorted(self._pending):
+            if not self.RE_DATA_FN.match(os.path.basename(data_filename)):
+                self._pending.discard(data_filename)
+                continue
+            dump_ts, realm_hash = self._parse_fn(data_filename)
+            if self._is_skipped(dump_ts, realm_hash):
+                self._pending.discard(data_filename)
+                continue
+            if realm_hash in blocked:
+                continue
+            try:
+                mtime = os.path.getmtime(data_filename)
+            except OSError:
+                self._pending.discard(data_filename)
+                self._failed.pop(data_filename, None)
+                continue
+            if data_filename not in self._closed:
+                if self._failed.get(data_filename) == mtime:
+                    blocked.add(realm_hash)
+                    continue
+                if time.time() - mtime < self._settle_time:
+                    # may still be being written, it and everything after it waits
+                    break
+            ready.append((data_filename, dump_ts, realm_hash))
+        for data_filename, _, _ in ready:
+            self._pending.discard(data_filename)
+            self._closed.discard(data_filename)
+        return ready
+
+    def _set_failed(self, data_filename):
+        try:
+            self._failed[data_filename] = os.path.getmtime(data_filename)
+        except OSError:
+            return
+        logger.error('Failed to load %s, retrying once it changes', data_filename)
+        self._pending.add(data_filename)
+
+    def _wait_for_files(self):
+        if self._notifier is not None:
+            if self._notifier.check_events(timeout=int(self._poll_interval * 1000)):
+                self._notifier.read_events()
+                self._notifier.process_events()
+            return
+        time.sleep(self._poll_interval)
+        # only list the directory when something in it changed
+        mtime = os.path.getmtime(self._path)
+        if mtime != self._dir_mtime:
+            self._dir_mtime = mtime
+            self._pending.update(self._list_new_files())
+
+    def _list_new_files(self):
+        """The dump filenames that sort after the earliest resume point."""
+        hashes = self._last_ts.keys() if self._realm_hashes is None else self._realm_hashes
+        resume_ts = min([self._last_ts.get(h, self._skip_before) for h in hashes] or [self._skip_before])
+        # a timestamp at the resume point sorts after this as well, _is_skipped() drops it
+        resume_fn = 'auctions-{:013d}-'.format(
+            calendar.timegm(max(resume_ts, self._skip_before).utctimetuple()) * 1000)
+        return [os.path.join(self._path, fn) for fn in os.listdir(self._path) \
+            if fn > resume_fn and fn.startswith('auctions-') and fn.endswith('.json.bz2')]
+
+    def _start_notifier(self):
+        watch_manager = pyinotify.WatchManager()
+        # IN_CLOSE_WRITE / IN_MOVED_TO only fire once a file is complete
+        watch_manager.add_watch(self._path, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO)
+        self._notifier = pyinotify.Notifier(watch_manager, default_proc_fun=self._on_event)
+
+    def _on_event(self, event):
+        self._pending.add(event.pathname)
+        self._closed.add(event.pathname)
+
+def get_last_timestamps():
+    """The last ParsedFile timestamp of each realm hash."""
+    return dict(ParsedFile.select(
+        ParsedFile.hash, fn.Max(ParsedFile.timestamp)
+    ).group_by(ParsedFile.hash).tuples())
+
+def _check_realm_keys(start, end):
+    """Refuse to estimate results while auctions that started from ``start``
+    to ``end`` have no realm key, they would be missing from their siblings.
+    """
+    count = Auction.select().where(
+        Auction.realm_key.is_null(True) &
+        Auction.started_at.between(start, end)
+    ).count()
+    if count:
+        raise RuntimeError('Auctions without a realm key: %d, run with --assign-realm-keys first' % count)
+
+def _load_data_file(data_src, data_filename, ts, realm_hash):
+    # module level so that it can be handed to a multiprocessing.Pool
+    try:
+        return data_src._load_data(data_filename, ts, realm_hash)
+    except Exception as err:
+        logger.exception(err)
+        return None
+
+# statements for DataManager.import_data(staging=True), "?" is swapped for the
+# database's own parameter style before execution
+STMT_STAGING_DROP = """
+DROP TABLE IF EXISTS auction_staging
+;
+"""
+STMT_STAGING_CREATE = """
+CREATE TEMPORARY TABLE auction_staging (
+        auc_id          INTEGER NOT NULL
+        , owner         VARCHAR(255)
+        , owner_realm   VARCHAR(255)
+        , quantity      INTEGER NOT NULL
+        , buyout        INTEGER
+        , item_id       INTEGER NOT NULL
+        , rand          INTEGER NOT NULL
+        , seed          INTEGER NOT NULL
+        , context       INTEGER NOT NULL
+        , attr_set_id   INTEGER
+        , bid           INTEGER NOT NULL
+        , time_left     INTEGER NOT NULL
+        , auction_id    INTEGER
+        , is_new        INTEGER NOT NULL DEFAULT 0
+    )
+;
+"""
+STMT_STAGING_INDEX = """
+CREATE INDEX auction_staging_auc_id ON auction_staging (auc_id)
+;
+"""
+STMT_STAGING_MATCH_ACTIVE = """
+UPDATE auction_staging
+    SET auction_id = (
+        SELECT
+                max(a.id)
+            FROM {auction} a
+            WHERE
+                a.auc_id = auction_staging.auc_id
+                AND (a.owner_realm = auction_staging.owner_realm
+                    OR (a.owner_realm IS NULL AND auction_staging.owner_realm IS NULL))
+                AND a.realm_key = ?
+                AND a.ended_at IS NULL
+                AND a.started_at BETWEEN ? AND ?
+    )
+;
+"""
+STMT_STAGING_MARK_NEW = """
+UPDATE auction_staging
+    SET is_new = 1
+    WHERE auction_id IS NULL
+;
+"""
+STMT_STAGING_END_AUCTIONS = """
+UPDATE {auction}
+    SET ended_at = ?
+    WHERE
+        realm_key = ?
+        AND ended_at IS NULL
+        AND started_at BETWEEN ? AND ?
+        AND NOT EXISTS (
+            SELECT
+                    1
+                FROM auction_staging s
+                WHERE
+                    s.auc_id = {auction}.auc_id
+                    AND (s.owner_realm = {auction}.owner_realm
+                        OR (s.owner_realm IS NULL AND {auction}.owner_realm IS NULL))
+        )
+;
+"""
+STMT_STAGING_INSERT_AUCTIONS = """
+INSERT INTO {auction} (
+        auc_id, owner, owner_realm, quantity, buyout, item_id, rand, seed, context,
+        attr_set_id, realm_key, started_at, created_at)
+    SELECT
+            auc_id, owner, owner_realm, quantity, buyout, item_id, rand, seed, context,
+            attr_set_id, ?, ?, ?
+        FROM auction_staging
+        WHERE is_new = 1
+;
+"""
+STMT_STAGING_MATCH_NEW = """
+UPDATE auction_staging
+    SET auction_id = (
+        SELECT
+                max(a.id)
+            FROM {auction} a
+            WHERE
+                a.auc_id = auction_staging.auc_id
+                AND (a.owner_realm = auction_staging.owner_realm
+                    OR (a.owner_realm IS NULL AND auction_staging.owner_realm IS NULL))
+                AND a.realm_key = ?
+                AND a.started_at = ?
+    )
+    WHERE is_new = 1
+;
+"""
+STMT_STAGING_INSERT_SNAPSHOTS = """
+INSERT INTO {snapshot} (auction_id, timestamp, bid, time_left)
+    SELECT
+            auction_id, ?, bid, time_left
+        FROM auction_staging
+;
+"""
+
+STMT_ITEM_STATS_STARTED = """
+SELECT
+        item_id
+        , count(*)
+        , sum(quantity)
+        , max(quantity)
+        , count(buyout)
+        , sum(CASE WHEN buyout IS NOT NULL THEN quantity ELSE 0 END)
+        , max(CASE WHEN buyout IS NOT NULL THEN quantity END)
+        , sum(buyout)
+        , sum(CAST(buyout AS float) / quantity)
+        , min(CAST(buyout AS float) / quantity)
+        , max(CAST(buyout AS float) / quantity)
+    FROM {auction}
+    WHERE
+        realm_key = ?
+        AND started_at = ?
+    GROUP BY item_id
+;
+"""
+# ItemStats metrics in STMT_ITEM_STATS_STARTED column order (after item_id)
+ITEM_STATS_STARTED_METRICS = ItemStats.METRICS[:10]
+STMT_ITEM_STATS_ENDED = """
+SELECT
+        item_id
+        , count(*)
+    FROM {auction}
+    WHERE
+        realm_key = ?
+        AND ended_at = ?
+    GROUP BY item_id
+;
+"""
+STMT_ITEM_STATS_WON = """
+SELECT
+        realm_key
+        , item_id
+        , ended_at
+        , count(*)
+    FROM {auction}
+    WHERE
+        est_result IN ('WON_BUYOUT', 'WON_BID')
+        AND ended_at >= ?
+        AND ended_at < ?
+    GROUP BY realm_key, item_id, ended_at
+;
+"""
+STMT_PRICE_SKETCH_STARTED = """
+SELECT
+        item_id
+        , quantity
+        , buyout
+    FROM {auction}
+    WHERE
+        realm_key = ?
+        AND started_at = ?
+        AND buyout IS NOT NULL
+;
+"""
+
 class DataManager(object):
-    def import_data(self, data_src, batch_size=50, day_buffer=7):
-        # aids = Auction IDs
+    # Auction columns copied through auction_staging
+    STAGING_AUCTION_KEYS = ['auc_id', 'owner', 'owner_realm', 'quantity', 'buyout',
+        'item_id', 'rand', 'seed', 'context']
+    STAGING_COLUMNS = STAGING_AUCTION_KEYS + ['bid', 'time_left', 'attr_set_id']
+
+    def __init__(self, sinks=()):
+        # realm key -> open auctions carried between dumps, see _get_open_auctions()
+        self._open_auctions = {}
+        self._open_auctions_ts = {}
+        # realm keys whose older open auctions have been claimed, see _claim_open_auctions()
+        self._claimed_realm_keys = set()
+        self._attr_sets = AttributeSetCache()
+        # MetricsSinks, and the ImportStats and realm key of the dump being imported
+        self._sinks = list(sinks)
+        self._stats = ImportStats()
+        self._realm_key = None
+
+    def import_data(self, data_src, batch_size=50, day_buffer=7, staging=False):
         for data in data_src:
             ts = data['timestamp']
+            realm_key = data['realm_key']
             dt = datetime.timedelta(days=day_buffer)
             try:
-                f = ParsedFile.get(ParsedFile.timestamp == ts)
+                f = ParsedFile.get((ParsedFile.realm_key == realm_key) & (ParsedFile.timestamp == ts))
                 logger.debug('File has been parsed before: %s', f.timestamp)
                 continue
             except DoesNotExist:
                 pass
-            logger.debug('Finding active auctions...')
-            active_aids = set(a.auc_id for a in Auction.select().where(
-                Auction.ended_at.is_null(True) &
-                Auction.started_at.between(ts - dt, ts)
-            ))
-            logger.debug('Found active auction IDs: %d', len(active_aids))
+            self._stats = stats = data.get('stats') or ImportStats()
+            self._realm_key = realm_key
+            query_count = QUERY_COUNTER.count
+            attr_set_count = self._attr_sets.created_count
+            start = time.time()
+            if realm_key not in self._claimed_realm_keys:
+                self._claim_open_auctions(ts, dt)
+            try:
+                with GlobalMeta.database.atomic():
+                    if staging:
+                        self._open_auctions.pop(realm_key, None)
+                        self._import_staged(data, ts, dt)
+                    else:
+                        self._import_direct(data, ts, dt, batch_size)
+                    with stats.phase('item_stats'):
+                        self._update_item_stats(ts, realm_key)
+                    with stats.phase('price_sketches'):
+                        self._update_price_sketches(ts, realm_key)
+                    ParsedFile.create(realm_key=realm_key, hash=data['realm_hash'], timestamp=ts)
+            except (IOError, EOFError, ValueError) as err:
+                # a truncated or corrupt (streamed) dump, only it is rolled back
+                logger.exception(err)
+                logger.error('Failed to import dump: %s', data['filename'])
+                data_src.mark_failed(data)
+                continue
+            stats.add_time('import_total', time.time() - start)
+            stats.count('queries', QUERY_COUNTER.count - query_count)
+            stats.count('attribute_sets_created', self._attr_sets.created_count - attr_set_count)
+            for sink in self._sinks:
+                sink.write(ts, realm_key, stats)
 
-            logger.debug('Finding ended auctions...')
-            ended_aids = list(active_aids - set(a['auc'] for a in data['auctions']))
-            logger.debug('Found ended auction IDs: %d', len(ended_aids))
-            with GlobalMeta.database.atomic():
-                for i in tqdm(range(0, len(ended_aids), batch_size), disable=OPTION_DISABLE_PROGRESS_BAR):
-                    Auction.update(ended_at=ts).where(
-                        (Auction.auc_id << ended_aids[i:i+batch_size]) & #probably over a size limit
-                        Auction.started_at.between(ts - dt, ts)
-                    ).execute()
-            del ended_aids
+    def _claim_open_auctions(self, ts, dt):
+        """Set the realm key of the realm group's open auctions that were
+        imported before it was stored, so that they are continued rather
+        than imported again. See _get_realm_group_where().
+        """
+        realm_key = self._realm_key
+        count = Auction.update(realm_key=realm_key).where(
+            Auction.realm_key.is_null(True) &
+            Auction.ended_at.is_null(True) &
+            Auction.started_at.between(ts - dt, ts) &
+            self._get_realm_group_where(realm_key, ts - dt, ts)
+        ).execute()
+        if count:
+            logger.info('Claimed open auctions for %s: %d', realm_key, count)
+        self._claimed_realm_keys.add(realm_key)
 
-            logger.debug('Finding new auctions...')
-            new_auctions = [a for a in data['auctions'] if a['auc'] not in active_aids]
-            logger.debug('Found new auctions: %d', len(new_auctions))
-            with GlobalMeta.database.atomic():
-                for i in tqdm(range(0, len(new_auctions), batch_size), disable=OPTION_DISABLE_PROGRESS_BAR):
-                    Auction.insert_many(
-                        [Auction.from_json(a, ts) for a in new_auctions[i:i+batch_size]]
-                    ).execute()
+    def assign_realm_keys(self):
+        """Set the realm key of all auctions imported before it was stored.
 
-            logger.debug('Finding new auction snapshots...')
-            new_auction_models = {a.auc_id: a for a in Auction.select().where(Auction.started_at == ts)}
-            new_auction_objs = {a['auc']: a for a in new_auctions}
-            new_aids = new_auction_models.keys()
-            del new_auctions
-            logger.debug('Inserting new auction snapshots: %d', len(new_auction_models))
+        Auctions go to the realm group they belong to by
+        _get_realm_group_where(), or all to the only one if there is just
+        one. Run rebuild_item_stats() afterwards, the stats only count
+        auctions of the realm group being updated.
+        """
+        realm_keys = [k for (k,) in ParsedFile.select(ParsedFile.realm_key).distinct().tuples()]
+        for realm_key in realm_keys:
+            where = Auction.realm_key.is_null(True)
+            if len(realm_keys) > 1:
+                where &= self._get_realm_group_where(realm_key)
             with GlobalMeta.database.atomic():
-                for i in tqdm(range(0, len(new_auction_models), batch_size), disable=OPTION_DISABLE_PROGRESS_BAR):
-                    Snapshot.insert_many(
-                        [Snapshot.from_json(new_auction_models[aid], new_auction_objs[aid], ts) \
-                            for aid in new_aids[i:i+batch_size]]
-                    ).execute()
-            logger.debug('Finding new item attributes...')
-            new_item_metas = list(itertools.chain.from_iterable(
-                ItemAttribute.from_json(a, new_auction_objs[aid]) \
-                for aid, a in new_auction_models.iteritems()
-            ))
-            logger.debug('Inserting new item attributes: %d', len(new_item_metas))
+                count = Auction.update(realm_key=realm_key).where(where).execute()
+            logger.info('Assigned auctions to %s: %d', realm_key, count)
+        count = Auction.select().where(Auction.realm_key.is_null(True)).count()
+        if count:
+            logger.warning('Auctions left without a realm key: %d', count)
+
+    def _get_realm_group_where(self, realm_key, start=None, end=None):
+        """Condition for the auctions of a realm group that have no realm key.
+
+        ParsedFile timestamps were unique before auctions had a realm key, so
+        an auction belongs to the realm group of the dump it started in,
+        unless another realm group has a dump at that time as well (imported
+        since). This also covers the auctions of realms missing from their
+        dump's realm list, which have no ``owner_realm``. Otherwise it
+        belongs to the realm group its owner's realm is in.
+        """
+        timestamps = ParsedFile.select(ParsedFile.timestamp)
+        if start is not None:
+            timestamps = timestamps.where(ParsedFile.timestamp.between(start, end))
+        return ((Auction.started_at << timestamps.where(ParsedFile.realm_key == realm_key)) & \
+                ~(Auction.started_at << timestamps.where(ParsedFile.realm_key != realm_key))) | \
+            (Auction.owner_realm << realm_key.split('+'))
+
+    def rebuild_item_stats(self):
+        """Recompute ItemStats and PriceSketch from scratch, e.g. for data
+        imported before they existed.
+
+        Each month is rebuilt in its own transaction, since the partitions
+        it needs are attached in between (see PartitionManager.route()).
+        Auctions without a realm key are left out, see assign_realm_keys().
+        """
+        with GlobalMeta.database.atomic():
+            ItemStats.delete().execute()
+            PriceSketch.delete().execute()
+        parsed = list(ParsedFile.select(ParsedFile.realm_key, ParsedFile.timestamp).order_by(
+            ParsedFile.timestamp.asc()).tuples())
+        for month, month_parsed in itertools.groupby(parsed, lambda p: _get_month(p[1])):
+            # auctions that ended in the month can have started before it
+            auction = PARTITIONS.route(month - datetime.timedelta(days=7), _next_month(month))
             with GlobalMeta.database.atomic():
-                for i in tqdm(range(0, len(new_item_metas), batch_size), disable=OPTION_DISABLE_PROGRESS_BAR):
-                    ItemAttribute.insert_many(new_item_metas[i:i+batch_size]).execute()
-            del new_auction_models
-            # del new_auction_objs
-            del new_item_metas
-
-            logger.debug('Finding old auction snapshots...')
-            new_snapshots = [a for a in data['auctions'] if a['auc'] in active_aids]
-            new_snapshot_models = {a.auc_id: a for a in Auction.select().where(
-                Auction.ended_at.is_null(True) &
-                Auction.started_at.between(ts - dt, ts - datetime.timedelta(seconds=1))
-            )}
-            new_snapshot_objs = {a['auc']: a for a in new_snapshots}
-            new_aids = new_snapshot_models.keys()
-            del new_snapshots
-            logger.debug('Inserting old auction snapshots: %d', len(new_snapshot_models))
+                for realm_key, ts in tqdm(list(month_parsed), disable=OPTION_DISABLE_PROGRESS_BAR):
+                    self._update_item_stats(ts, realm_key, auction=auction)
+                    self._update_price_sketches(ts, realm_key, auction=auction)
+                won = collections.defaultdict(dict)
+                for realm_key, item_id, ended_at, won_count in self._execute(STMT_ITEM_STATS_WON,
+                        (month, _next_month(month)), auction=auction):
+                    won[(realm_key, ended_at)][item_id] = {'won_count': won_count}
+                for (realm_key, ended_at), deltas in won.iteritems():
+                    ItemStats.add_deltas(deltas, Auction.ended_at.python_value(ended_at), realm_key)
+
+    def normalize_item_attributes(self, batch_size=1000):
+        """Move ItemAttribute rows into AttributeSets, for data imported
+        before they existed.
+
+        Each batch of auctions is converted and its ItemAttribute rows
+        deleted in its own transaction, so this can be interrupted and rerun.
+        """
+        auction_ids = [pk for (pk,) in ItemAttribute.select(
+            ItemAttribute.auction).distinct().tuples()]
+        logger.debug('Found auctions with item attributes: %d', len(auction_ids))
+        for chunk in tqdm(list(_chunks(auction_ids, batch_size)), disable=OPTION_DISABLE_PROGRESS_BAR):
+            try:
+                with GlobalMeta.database.atomic():
+                    self._normalize_item_attributes(chunk)
+            except Exception:
+                self._attr_sets.reset()
+                raise
+
+    def _normalize_item_attributes(self, auction_ids):
+        attrs = collections.defaultdict(list)
+        for auction_id, key, value in ItemAttribute.select(
+                ItemAttribute.auction, ItemAttribute.attribute, ItemAttribute.value
+            ).where(ItemAttribute.auction << auction_ids).tuples():
+            attrs[auction_id].append((key, value))
+        by_set = collections.defaultdict(list)
+        for auction_id, auction_attrs in attrs.iteritems():
+            by_set[self._attr_sets.get_id(auction_attrs)].append(auction_id)
+        for set_id, ids in by_set.iteritems():
+            Auction.update(attr_set=set_id).where(Auction.id << ids).execute()
+        ItemAttribute.delete().where(ItemAttribute.auction << auction_ids).execute()
+
+    def compact_snapshots(self, cutoff, batch_size=1000):
+        """Fold the Snapshots of auctions that ended before ``cutoff`` into
+        the Auction summary fields and delete them.
+
+        Estimating a result needs the snapshots, so results are estimated
+        first (with ResultEstimator when numpy is available) and auctions
+        without one are left alone. Each day is compacted in its own
+        transaction. Like the estimates, this refuses to run while auctions
+        have no realm key (see assign_realm_keys()).
+        """
+        start = Auction.select(fn.Min(Auction.ended_at)).where(
+            (Auction.ended_at < cutoff) &
+            Auction.snapshot_count.is_null(True)
+        ).scalar(convert=True)
+        while start is not None and start < cutoff:
+            end = min(start + datetime.timedelta(days=1), cutoff)
+            if numpy is not None:
+                ResultEstimator(batch_size=batch_size).estimate(start, end)
+            else:
+                self.estimate_results(start, end)
             with GlobalMeta.database.atomic():
-                for i in tqdm(range(0, len(new_snapshot_models), batch_size), disable=OPTION_DISABLE_PROGRESS_BAR):
-                    Snapshot.insert_many(
-                        [Snapshot.from_json(new_snapshot_models[aid], new_snapshot_objs[aid], ts) \
-                            for aid in new_aids[i:i+batch_size]]
+                count = self._compact_snapshots(start, end, batch_size)
+            logger.debug('Compacted auctions ended before %s: %d', end, count)
+            start = end
+
+    def estimate_results(self, start, end):
+        """Estimate the results of auctions with ``start <= ended_at <= end``
+        one at a time with Auction.estimate_result(), for when numpy is not
+        available. Their buyout siblings are loaded into an
+        AuctionIntervalIndex up front instead of being queried per auction.
+        """
+        where = Auction.ended_at.between(start, end) & \
+            Auction.est_result.is_null(True) & Auction.snapshot_count.is_null(True)
+        # auctions without any snapshots can not be estimated
+        with_snaps = set(pk for pk, in Snapshot.select(Snapshot.auction).join(Auction).where(
+            where).distinct().tuples())
+        targets = [a for a in Auction.select().where(where) if a.id in with_snaps]
+        if not targets:
+            return 0
+        lo = min(a.started_at for a in targets)
+        hi = max(a.ended_at for a in targets)
+        _check_realm_keys(lo - MAX_AUCTION_DURATION, hi)
+        siblings = AuctionIntervalIndex(PARTITIONS.select(Auction.select(
+            Auction.id, Auction.realm_key, Auction.item_id, Auction.quantity, Auction.buyout,
+            Auction.started_at, Auction.ended_at
+        ).where(Auction.buyout.is_null(False) &
+            (Auction.started_at.between(lo, hi) | Auction.ended_at.between(lo, hi))),
+            lo - MAX_AUCTION_DURATION, hi))
+        # (realm_key, ended_at) -> {item_id: won count}
+        won = collections.defaultdict(lambda: collections.defaultdict(int))
+        with GlobalMeta.database.atomic():
+            for auction in tqdm(targets, disable=OPTION_DISABLE_PROGRESS_BAR):
+                result = auction.estimate_result(siblings=siblings)
+                Auction.update(est_result=result, est_ended_at=auction.estimate_ended_at()).where(
+                    Auction.id == auction.id).execute()
+                if result in ('WON_BUYOUT', 'WON_BID'):
+                    won[(auction.realm_key, auction.ended_at)][auction.item_id] += 1
+            for (realm_key, ended_at), counts in won.iteritems():
+                ItemStats.add_deltas(dict((item_id, {'won_count': n}) for item_id, n in counts.iteritems()),
+                    ended_at, realm_key)
+        logger.debug('Estimated auction results: %d', len(targets))
+        return len(targets)
+
+    def _compact_snapshots(self, start, end, batch_size):
+        db = GlobalMeta.database
+        where = (Auction.ended_at >= start) & (Auction.ended_at < end) & \
+            Auction.est_result.is_null(False) & Auction.snapshot_count.is_null(True)
+        # auction id -> [snapshot_count, first_bid, last_bid, bid_change_count, first_time_left]
+        summaries = collections.OrderedDict()
+        for auction_id, bid, time_left in Snapshot.select(
+                Snapshot.auction, Snapshot.bid, Snapshot.time_left
+            ).join(Auction).where(where).order_by(
+                Snapshot.auction.asc(), Snapshot.timestamp.asc()
+            ).tuples():
+            summary = summaries.get(auction_id)
+            if summary is None:
+                summaries[auction_id] = [1, bid, bid, 0, time_left]
+            else:
+                summary[0] += 1
+                summary[3] += int(bid != summary[2])
+                summary[2] = bid
+        sql = 'UPDATE {0}{1}{0} SET snapshot_count = {2}, first_bid = {2}, last_bid = {2}, ' \
+            'bid_change_count = {2}, first_time_left = {2} WHERE id = {2}'.format(
+                db.quote_char, Auction._meta.db_table, db.interpolation)
+        rows = [tuple(summary) + (pk,) for pk, summary in summaries.iteritems()]
+        for chunk in _chunks(rows, batch_size):
+            db.get_cursor().executemany(sql, chunk)
+            QUERY_COUNTER.add()
+        for chunk in _chunks(summaries.keys(), batch_size):
+            Snapshot.delete().where(Snapshot.auction << chunk).execute()
+        return len(summaries)
+
+    def _update_item_stats(self, ts, realm_key, auction=None):
+        logger.debug('Updating item stats...')
+        deltas = collections.defaultdict(dict)
+        for row in self._execute(STMT_ITEM_STATS_STARTED, (realm_key, ts), auction=auction):
+            deltas[row[0]].update(itertools.izip(ITEM_STATS_STARTED_METRICS, row[1:]))
+        for item_id, ended_count in self._execute(STMT_ITEM_STATS_ENDED, (realm_key, ts),
+                auction=auction):
+            deltas[item_id]['ended_count'] = ended_count
+        ItemStats.add_deltas(deltas, ts, realm_key)
+        logger.debug('Updated item stats: %d', len(deltas))
+
+    def _update_price_sketches(self, ts, realm_key, auction=None):
+        logger.debug('Updating price sketches...')
+        prices = collections.defaultdict(list)
+        for item_id, quantity, buyout in self._execute(STMT_PRICE_SKETCH_STARTED, (realm_key, ts),
+                auction=auction):
+            prices[(item_id, quantity)].append(float(buyout) / quantity)
+        PriceSketch.add_prices(prices, ts, realm_key)
+        logger.debug('Updated price sketches: %d', len(prices))
+
+    def _import_direct(self, data, ts, dt, batch_size):
+        try:
+            with self._stats.phase('find_active'):
+                open_auctions = self._get_open_auctions(ts, dt)
+            self._import_direct_with(open_auctions, data, ts, batch_size)
+        except Exception:
+            # the in-memory state may no longer match the DB, reload it next time
+            self._open_auctions.pop(self._realm_key, None)
+            self._attr_sets.reset()
+            BULK_WRITER.discard()
+            raise
+
+    def _import_direct_with(self, open_auctions, data, ts, batch_size):
+        # the dump is consumed in a single pass so that it can be a
+        # generator (see DataSource(streaming=True))
+        stats = self._stats
+        seen_keys = set()
+        new_auctions = []
+        old_auctions = []
+        new_count = old_count = 0
+        with GlobalMeta.database.atomic():
+            # the time not spent on inserts is reading (if streaming) and diffing
+            start = time.time()
+            insert_seconds = stats.timings.get('insert_new', 0) + stats.timings.get('insert_old', 0)
+            for a in tqdm(data['auctions'], disable=OPTION_DISABLE_PROGRESS_BAR):
+                key = (a.auc_id, a.owner_realm)
+                seen_keys.add(key)
+                if key in open_auctions:
+                    old_auctions.append(a)
+                    if len(old_auctions) >= batch_size:
+                        old_count += self._insert_old_auctions(old_auctions, open_auctions, ts)
+                        old_auctions = []
+                else:
+                    new_auctions.append(a)
+                    if len(new_auctions) >= batch_size:
+                        new_count += self._insert_new_auctions(new_auctions, open_auctions, ts)
+                        new_auctions = []
+            if old_auctions:
+                old_count += self._insert_old_auctions(old_auctions, open_auctions, ts)
+            if new_auctions:
+                new_count += self._insert_new_auctions(new_auctions, open_auctions, ts)
+            insert_seconds = stats.timings.get('insert_new', 0) + stats.timings.get('insert_old', 0) - \
+                insert_seconds
+            stats.add_time('diff', time.time() - start - insert_seconds)
+            with stats.phase('flush'):
+                BULK_WRITER.flush()
+            del old_auctions, new_auctions
+            logger.debug('Inserted old auction snapshots: %d', old_count)
+            logger.debug('Inserted new auctions: %d', new_count)
+            stats.count('auctions', old_count + new_count)
+            stats.count('new_auctions', new_count)
+            stats.count('snapshots', old_count + new_count)
+
+            logger.debug('Finding ended auctions...')
+            with stats.phase('end_auctions'):
+                ended_ids = [open_auctions.pop(key)[0] for key in set(open_auctions) - seen_keys]
+                del seen_keys
+                logger.debug('Found ended auction IDs: %d', len(ended_ids))
+                for i in tqdm(range(0, len(ended_ids), batch_size), disable=OPTION_DISABLE_PROGRESS_BAR):
+                    Auction.update(ended_at=ts).where(
+                        Auction.id << ended_ids[i:i+batch_size]
                     ).execute()
+            stats.count('ended_auctions', len(ended_ids))
+
+    def _get_open_auctions(self, ts, dt):
+        """Return the realm group's (auc_id, owner_realm) -> (Auction.id, started_at) map.
+
+        The map is loaded from the DB once and then carried from dump to
+        dump, with only auctions that fell out of the ``dt`` window dropped.
+        """
+        realm_key = self._realm_key
+        open_auctions = self._open_auctions.get(realm_key)
+        if open_auctions is None or ts < self._open_auctions_ts[realm_key]:
+            logger.debug('Finding active auctions...')
+            open_auctions = self._open_auctions[realm_key] = {(auc_id, owner_realm): (pk, started_at) \
+                for auc_id, owner_realm, pk, started_at in Auction.select(
+                    Auction.auc_id, Auction.owner_realm, Auction.id, Auction.started_at
+                ).where(
+                    (Auction.realm_key == realm_key) &
+                    Auction.ended_at.is_null(True) &
+                    Auction.started_at.between(ts - dt, ts)
+                ).tuples()}
+        else:
+            for key in [k for k, v in open_auctions.iteritems() if v[1] < ts - dt]:
+                del open_auctions[key]
+        self._open_auctions_ts[realm_key] = ts
+        logger.debug('Found active auction IDs: %d', len(open_auctions))
+        return open_auctions
+
+    def _import_staged(self, data, ts, dt):
+        """Load the dump into temporary tables and diff it in SQL.
+
+        Instead of pulling the active auction IDs into Python, the whole
+        dump is bulk loaded into ``auction_staging`` and the ended, new and
+        continuing auctions are each handled by a single statement.
+        """
+        try:
+            self._import_staged_with(data, ts, dt)
+        except Exception:
+            self._attr_sets.reset()
+            BULK_WRITER.discard()
+            raise
+
+    def _import_staged_with(self, data, ts, dt):
+        stats = self._stats
+        with GlobalMeta.database.atomic():
+            self._execute(STMT_STAGING_DROP)
+            self._execute(STMT_STAGING_CREATE)
+
+            logger.debug('Loading auctions into staging table...')
+            auction_count = 0
+            with stats.phase('staging_load'):
+                for a in tqdm(data['auctions'], disable=OPTION_DISABLE_PROGRESS_BAR):
+                    BULK_WRITER.write('auction_staging', self.STAGING_COLUMNS, [
+                        tuple(getattr(a, k) for k in self.STAGING_AUCTION_KEYS) +
+                        (a.bid, a.time_left, self._attr_sets.get_id(a.attrs))])
+                    auction_count += 1
+                BULK_WRITER.flush()
+                self._execute(STMT_STAGING_INDEX)
+            logger.debug('Loaded auctions: %d', auction_count)
+            stats.count('auctions', auction_count)
+
+            logger.debug('Matching active auctions...')
+            with stats.phase('find_active'):
+                self._execute(STMT_STAGING_MATCH_ACTIVE, (self._realm_key, ts - dt, ts))
+                self._execute(STMT_STAGING_MARK_NEW)
+            logger.debug('Marking ended auctions...')
+            with stats.phase('end_auctions'):
+                c = self._execute(STMT_STAGING_END_AUCTIONS, (ts, self._realm_key, ts - dt, ts))
+            logger.debug('Found ended auctions: %d', c.rowcount)
+            stats.count('ended_auctions', c.rowcount)
+            logger.debug('Inserting new auctions...')
+            with stats.phase('insert_new'):
+                c = self._execute(STMT_STAGING_INSERT_AUCTIONS,
+                    (self._realm_key, ts, datetime.datetime.utcnow()))
+                self._execute(STMT_STAGING_MATCH_NEW, (self._realm_key, ts))
+            logger.debug('Inserted new auctions: %d', c.rowcount)
+            stats.count('new_auctions', c.rowcount)
+            with stats.phase('insert_old'):
+                c = self._execute(STMT_STAGING_INSERT_SNAPSHOTS, (ts,))
+            logger.debug('Inserted auction snapshots: %d', c.rowcount)
+            stats.count('snapshots', c.rowcount)
+
+            self._execute(STMT_STAGING_DROP)
+
+    def _format_stmt(self, stmt, **tables):
+        db = GlobalMeta.database
+        names = {
+            'auction':      Auction._meta.db_table,
+            'snapshot':     Snapshot._meta.db_table,
+        }
+        # None keeps the default, e.g. for a table from PartitionManager.route()
+        names.update((k, v) for k, v in tables.iteritems() if v is not None)
+        return stmt.format(**names).replace('?', db.interpolation)
+
+    def _execute(self, stmt, params=None, **tables):
+        return GlobalMeta.database.execute_sql(self._format_stmt(stmt, **tables), params)
+
+    def _insert_new_auctions(self, auctions, open_auctions, ts):
+        with self._stats.phase('insert_new'):
+            return self._insert_new_auctions_with(auctions, open_auctions, ts)
+
+    def _insert_new_auctions_with(self, auctions, open_auctions, ts):
+        rows = []
+        for a in auctions:
+            row = Auction.from_record(a, ts)
+            row['attr_set'] = self._attr_sets.get_id(a.attrs)
+            row['realm_key'] = self._realm_key
+            rows.append(row)
+        new_auction_ids = self._insert_auctions(rows)
+        for a, pk in itertools.izip(auctions, new_auction_ids):
+            open_auctions[(a.auc_id, a.owner_realm)] = (pk, ts)
+        BULK_WRITER.write(Snapshot._meta.db_table, Snapshot.ROW_COLUMNS,
+            [Snapshot.to_row(pk, a, ts) for a, pk in itertools.izip(auctions, new_auction_ids)])
+        return len(auctions)
+
+    def _insert_auctions(self, rows):
+        """Insert Auction rows, returning their primary keys in row order."""
+        db = GlobalMeta.database
+        query = Auction.insert_many(rows)
+        if db.insert_returning:
+            return list(query.return_id_list().execute())
+        if isinstance(db.obj, SqliteDatabase):
+            # a multi-row INSERT gets consecutive rowids, ending at lastrowid
+            last_id = db.execute_sql(*query.sql()).lastrowid
+            return range(last_id - len(rows) + 1, last_id + 1)
+        query.execute()
+        ts = rows[0]['started_at']
+        pks = dict(((auc_id, owner_realm), pk) for auc_id, owner_realm, pk in Auction.select(
+            Auction.auc_id, Auction.owner_realm, Auction.id
+        ).where(
+            (Auction.started_at == ts) &
+            (Auction.auc_id << [r['auc_id'] for r in rows])
+        ).tuples())
+        return [pks[(r['auc_id'], r['owner_realm'])] for r in rows]
+
+    def _insert_old_auctions(self, auctions, open_auctions, ts):
+        with self._stats.phase('insert_old'):
+            BULK_WRITER.write(Snapshot._meta.db_table, Snapshot.ROW_COLUMNS,
+                [Snapshot.to_row(open_auctions[(a.auc_id, a.owner_realm)][0], a, ts) \
+                    for a in auctions])
+        return len(auctions)
+
+class RealmImporter(object):
+    """Imports the dumps of many realm groups at the same time.
+
+    Dumps are grouped by the realm hash in their filename and every group
+    is imported in timestamp order by one worker process, with its own DB
+    connection and DataManager (and so its own open auction state). Realm
+    groups never write to the same rows, so on PostgreSQL the workers run
+    fully in parallel. SQLite only allows one writer at a time, there the
+    workers mostly overlap reading and parsing dumps with each other's
+    writes. The metrics of every dump are written to ``sinks`` by this
+    process. A worker that dies without a word (e.g. killed for running out
+    of memory) only fails its own realm group.
+    """
+    # seconds between checks on the workers
+    POLL_INTERVAL       = 1.0
+
+    def __init__(self, db_url, path, workers, skip_before=0, streaming=False, resume=False,
+            sinks=()):
+        self._db_url = db_url
+        self._path = path
+        self._workers = workers
+        self._skip_before = skip_before
+        self._streaming = streaming
+        self._resume = resume
+        self._sinks = list(sinks)
+
+    def import_data(self, batch_size=50, day_buffer=7, staging=False):
+        """Import every realm group, returning the realm hashes that failed."""
+        data_src = DataSource(self._path, self._skip_before)
+        if self._resume:
+            data_src.resume()
+        realm_hashes = data_src.get_realm_hashes()
+        logger.info('Importing realm groups: %d', len(realm_hashes))
+        if not realm_hashes:
+            return []
+        # the workers open their own connections, this one is reopened when needed
+        GlobalMeta.database.close()
+        queue = multiprocessing.Queue()
+        # the largest realm groups go first, to finish at about the same time
+        waiting = collections.deque(realm_hashes)
+        # realm hash -> worker process, each one tells how it went by its exit code
+        running = {}
+        failed = []
+        try:
+            while waiting or running:
+                while waiting and len(running) < self._workers:
+                    realm_hash = waiting.popleft()
+                    running[realm_hash] = multiprocessing.Process(target=_import_realm_group,
+                        args=(self._db_url, queue, realm_hash, self._path, self._skip_before,
+                            self._streaming, self._resume, batch_size, day_buffer, staging))
+                    running[realm_hash].start()
+                self._write_metrics(queue, self.POLL_INTERVAL)
+                for realm_hash, proc in running.items():
+                    if proc.is_alive():
+                        continue
+                    proc.join()
+                    del running[realm_hash]
+                    if proc.exitcode != 0:
+                        logger.error('Realm group %s failed, worker exit code: %s',
+                            realm_hash, proc.exitcode)
+                        failed.append(realm_hash)
+            self._write_metrics(queue)
+        finally:
+            for proc in running.itervalues():
+                proc.terminate()
+                proc.join()
+        return failed
+
+    def _write_metrics(self, queue, timeout=None):
+        """Pass the queued metrics on to the sinks, waiting up to ``timeout``
+        seconds for the first.
+        """
+        try:
+            item = queue.get(timeout=timeout) if timeout else queue.get_nowait()
+            while True:
+                for sink in self._sinks:
+                    sink.write(*item)
+                item = queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+def _import_realm_group(db_url, queue, realm_hash, path, skip_before, streaming, resume,
+        batch_size, day_buffer, staging):
+    # module level so that it can be the target of a multiprocessing.Process
+    try:
+        db_connect(db_url)
+        data_src = DataSource(path, skip_before, streaming=streaming, realm_hashes=[realm_hash])
+        if resume:
+            data_src.resume()
+        DataManager(sinks=[QueueSink(queue)]).import_data(data_src,
+            batch_size=batch_size, day_buffer=day_buffer, staging=staging)
+    except Exception as err:
+        logger.exception(err)
+        raise SystemExit(1)
+
+class ItemNameCache(object):
+    """Item names from the ItemInfo table, with an LRU in front of it.
+
+    Names missing from the table are looked up on wowhead (like
+    contrib/get-item-name.sh) and stored, unless ``offline`` is set in which
+    case they are simply None.
+    """
+    ITEM_URL            = 'http://www.wowhead.com/item={}'
+    RE_ITEM_TITLE       = re.compile(r'.*>(.*) - Item .*')
+    # failed lookups are not stored, so they are retried next time
+    FETCH_FAILED        = object()
+
+    def __init__(self, offline=False, max_size=4096, batch_size=500, fetch_workers=8, timeout=10):
+        self._offline = offline
+        self._max_size = max_size
+        self._batch_size = batch_size
+        self._fetch_workers = fetch_workers
+        self._timeout = timeout
+        self._lru = collections.OrderedDict()
+
+    def get(self, item_id):
+        try:
+            name = self._lru.pop(item_id)
+        except KeyError:
+            self.prefetch([item_id])
+            name = self._lru.pop(item_id, None)
+        self._remember(item_id, name)
+        return name
+
+    def prefetch(self, item_ids):
+        """Load the names of many items with one query per batch, fetching
+        (in parallel) and storing any that are not in the table yet.
+        """
+        missing = set(item_ids) - set(self._lru)
+        for chunk in _chunks(sorted(missing), self._batch_size):
+            for item_id, name in ItemInfo.select(ItemInfo.item_id, ItemInfo.name).where(
+                    ItemInfo.item_id << chunk).tuples():
+                self._remember(item_id, name)
+                missing.discard(item_id)
+        if not missing or self._offline:
+            return
+        logger.debug('Fetching item names: %d', len(missing))
+        pool = ThreadPool(self._fetch_workers)
+        try:
+            names = pool.map(self.fetch_name, sorted(missing))
+        finally:
+            pool.close()
+        fetched = [(item_id, name) for item_id, name in itertools.izip(sorted(missing), names) \
+            if name is not self.FETCH_FAILED]
+        now = datetime.datetime.utcnow()
+        with GlobalMeta.database.atomic():
+            for chunk in _chunks(fetched, self._batch_size):
+                ItemInfo.insert_many([{'item_id': item_id, 'name': name, 'fetched_at': now} \
+                    for item_id, name in chunk]).execute()
+        for item_id, name in itertools.izip(sorted(missing), names):
+            self._remember(item_id, None if name is self.FETCH_FAILED else name)
+
+    def fetch_name(self, item_id):
+        """Look an item's name up on wowhead, returning FETCH_FAILED on errors."""
+        try:
+            page = urllib2.urlopen(self.ITEM_URL.format(item_id), timeout=self._timeout).read()
+        except Exception as err:
+            logger.warning('Unable to fetch item %d: %s', item_id, err)
+            return self.FETCH_FAILED
+        for line in page.decode('utf-8', 'replace').splitlines():
+            if '</title>' in line:
+                m = self.RE_ITEM_TITLE.match(line)
+                return m.group(1) if m else None
+        return None
+
+    def _remember(self, item_id, name):
+        self._lru[item_id] = name
+        while len(self._lru) > self._max_size:
+            self._lru.popitem(last=False)
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+# ended auctions of an item for PriceHistory, "?" is swapped for the
+# database's own parameter style before execution
+STMT_PRICE_HISTORY_POINTS = """
+SELECT
+        ended_at
+        , started_at
+        , quantity
+        , buyout
+    FROM {auction}
+    WHERE
+        item_id = ?
+        AND ended_at >= ?
+        AND ended_at < ?
+        AND buyout IS NOT NULL
+        {realm_filter}
+    ORDER BY ended_at
+;
+"""
+
+class PriceHistory(object):
+    """Buyout price per item history of items, e.g. for plotting.
+
+    points() returns every ended auction of an item, read through the
+    (item_id, ended_at) index. buckets() only reads the precomputed hourly
+    ItemStats and PriceSketch rows, so it stays fast for any time range.
+    Results are memoized until another dump has been imported, call clear()
+    after rebuilding the stats. Prices are in copper, times are UTC.
+    """
+    def __init__(self, cache_size=256):
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._cache_version = None
+
+    def points(self, item_id, start, end, realm_key=None, max_ratio=None):
+        """Return ``[(ended_at, buyout per item, quantity, hours active), ...]``
+        for the item's auctions that ended from ``start`` to ``end``.
+
+        With ``max_ratio``, auctions priced over that many times the average
+        (see summary()) are left out.
+        """
+        return self._memoize('points', item_id, start, end, realm_key, max_ratio)
+
+    def buckets(self, item_id, start, end, bucket_hours=24, realm_key=None):
+        """Return ``[(bucket_start, count, min, median, max), ...]`` of the
+        buyout per item, for buckets of ``bucket_hours`` from ``start``.
+
+        Buckets hold the auctions that started in them (like ItemStats) and
+        the medians come from the merged PriceSketches, so they are within
+        the sketches' relative accuracy. Empty buckets are left out.
+        """
+        return self._memoize('buckets', item_id, start, end, bucket_hours, realm_key)
+
+    def summary(self, item_id, start, end, realm_key=None):
+        """Return the item's buyout count, average, minimum and maximum
+        buyout per item and largest quantity, from the daily ItemStats.
+        """
+        return self._memoize('summary', item_id, start, end, realm_key)
+
+    def clear(self):
+        self._cache.clear()
+
+    def _memoize(self, name, *args):
+        version = ParsedFile.select(fn.Max(ParsedFile.id)).scalar()
+        if version != self._cache_version:
+            self._cache.clear()
+            self._cache_version = version
+        key = (name,) + args
+        try:
+            result = self._cache.pop(key)
+        except KeyError:
+            result = getattr(self, '_load_' + name)(*args)
+        self._cache[key] = result
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    def _load_points(self, item_id, start, end, realm_key, max_ratio):
+        db = GlobalMeta.database
+        max_ppi = None
+        if max_ratio is not None:
+            avg = self.summary(item_id, start, end, realm_key)['avg']
+            max_ppi = None if avg is None else avg * max_ratio
+        params = [item_id, start, end]
+        realm_filter = ''
+        if realm_key is not None:
+            realm_filter = 'AND realm_key = ?'
+            params.append(realm_key)
+        # auctions can run for up to two days
+        batches = PARTITIONS.route_batches(start - MAX_AUCTION_DURATION, end)
+        points = []
+        for route in batches:
+            for ended_at, started_at, quantity, buyout in db.execute_sql(
+                    STMT_PRICE_HISTORY_POINTS.format(auction=route(), realm_filter=realm_filter
+                    ).replace('?', db.interpolation), params):
+                ppi = float(buyout) / quantity
+                if max_ppi is not None and ppi >= max_ppi:
+                    continue
+                ended_at = Auction.ended_at.python_value(ended_at)
+                started_at = Auction.started_at.python_value(started_at)
+                points.append((ended_at, ppi, quantity,
+                    int((ended_at - started_at).total_seconds() // 3600)))
+        if len(batches) > 1:
+            points.sort(key=lambda p: p[0])
+        logger.debug('Loaded price history points for %d: %d', item_id, len(points))
+        return points
+
+    def _load_buckets(self, item_id, start, end, bucket_hours, realm_key):
+        first = ItemStats.get_period_start('hour', start)
+        size = datetime.timedelta(hours=bucket_hours)
+        # the daily rows will do for whole days, as long as they end at
+        # ``end`` too, like the hourly sketches
+        period = 'day' if bucket_hours % 24 == 0 and first.hour == 0 and \
+            end == ItemStats.get_period_start('day', end) else 'hour'
+        where = (ItemStats.item_id == item_id) & (ItemStats.period == period) & \
+            (ItemStats.period_start >= first) & (ItemStats.period_start < end)
+        if realm_key is not None:
+            where &= ItemStats.realm_key == realm_key
+        # bucket number -> [count, min, max, sketch]
+        buckets = {}
+        for period_start, count, ppi_min, ppi_max in ItemStats.select(
+                ItemStats.period_start, ItemStats.buyout_count,
+                ItemStats.buyout_ppi_min, ItemStats.buyout_ppi_max
+            ).where(where).tuples():
+            if not count:
+                continue
+            bucket = buckets.setdefault(self._get_bucket(first, size, period_start),
+                [0, None, None, QuantileSketch()])
+            bucket[0] += count
+            bucket[1] = ItemStats.merge_metric('buyout_ppi_min', bucket[1], ppi_min)
+            bucket[2] = ItemStats.merge_metric('buyout_ppi_max', bucket[2], ppi_max)
+        where = (PriceSketch.item_id == item_id) & \
+            (PriceSketch.period_start >= first) & (PriceSketch.period_start < end)
+        if realm_key is not None:
+            where &= PriceSketch.realm_key == realm_key
+        for period_start, value in PriceSketch.select(
+                PriceSketch.period_start, PriceSketch.sketch).where(where).tuples():
+            bucket = buckets.get(self._get_bucket(first, size, period_start))
+            if bucket is not None:
+                bucket[3].merge(QuantileSketch.loads(value))
+        return [(first + i * size, count, ppi_min, sketch.quantile(0.5) if sketch.count else None, ppi_max) \
+            for i, (count, ppi_min, ppi_max, sketch) in sorted(buckets.iteritems())]
+
+    def _get_bucket(self, first, size, period_start):
+        return int((period_start - first).total_seconds() // size.total_seconds())
+
+    def _load_summary(self, item_id, start, end, realm_key):
+        where = (ItemStats.item_id == item_id) & (ItemStats.period == 'day') & \
+            (ItemStats.period_start >= ItemStats.get_period_start('day', start)) & \
+            (ItemStats.period_start < end)
+        if realm_key is not None:
+            where &= ItemStats.realm_key == realm_key
+        count, ppi_sum, ppi_min, ppi_max, quantity_max = ItemStats.select(
+            fn.Sum(ItemStats.buyout_count), fn.Sum(ItemStats.buyout_ppi_sum),
+            fn.Min(ItemStats.buyout_ppi_min), fn.Max(ItemStats.buyout_ppi_max),
+            fn.Max(ItemStats.quantity_max)
+        ).where(where).tuples().get()
+        return {
+            'count':        count or 0,
+            'avg':          (ppi_sum / count) if count else None,
+            'min':          ppi_min,
+            'max':          ppi_max,
+            'quantity_max': quantity_max,
+        }
+
+def downsample_lttb(points, threshold):
+    """Pick ``threshold`` of the ``points`` with Largest-Triangle-Three-Buckets.
+
+    Points are tuples sorted by their first element (a datetime or number),
+    their second element is the value. The first and last points are always
+    kept, and of every bucket in between the one making the largest triangle
+    with the previously picked point and the next bucket's average, which
+    keeps the peaks and the overall shape of the series.
+    """
+    if threshold >= len(points) or threshold < 3:
+        return list(points)
+    xs = [calendar.timegm(p[0].utctimetuple()) if isinstance(p[0], datetime.datetime) else p[0] \
+        for p in points]
+    ys = [p[1] for p in points]
+    size = float(len(points) - 2) / (threshold - 2)
+    picked = [points[0]]
+    a = 0
+    for i in range(threshold - 2):
+        lo = int(i * size) + 1
+        hi = int((i + 1) * size) + 1
+        # the average of the next bucket, or the last point
+        next_lo, next_hi = hi, min(int((i + 2) * size) + 1, len(points))
+        if i == threshold - 3:
+            next_lo, next_hi = len(points) - 1, len(points)
+        avg_x = float(sum(xs[next_lo:next_hi])) / (next_hi - next_lo)
+        avg_y = float(sum(ys[next_lo:next_hi])) / (next_hi - next_lo)
+        best, best_area = lo, -1.0
+        for j in range(lo, hi):
+            area = abs((xs[a] - avg_x) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (avg_y - ys[a]))
+            if area > best_area:
+                best, best_area = j, area
+        picked.append(points[best])
+        a = best
+    picked.append(points[-1])
+    return picked
+
+class ColumnarArchive(object):
+    """Month partitioned, column per file archive of auctions and snapshots.
+
+    Each partition is a directory of ``<column>.npy`` files, so readers can
+    memory map a whole month and scan it with vectorized NumPy operations
+    without going through the DB. Auctions are partitioned by
+    ``started_at`` and snapshots by ``timestamp``. Missing values are -1 for
+    integer columns and NaT for times. ``realm_id`` is the index of the
+    auction's realm key in the partition's get_realm_keys().
+    """
+    TIME_DTYPE          = 'datetime64[s]'
+    # table -> (time field, [(column, field, dtype), ...])
+    TABLES              = {
+        'auctions':     (Auction.started_at, [
+            ('id',          Auction.id,             'int64'),
+            ('realm_id',    Auction.realm_key,      'int32'),
+            ('auc_id',      Auction.auc_id,         'int64'),
+            ('item_id',     Auction.item_id,        'int32'),
+            ('quantity',    Auction.quantity,       'int32'),
+            ('buyout',      Auction.buyout,         'int64'),
+            ('attr_set_id', Auction.attr_set,       'int64'),
+            ('started_at',  Auction.started_at,     TIME_DTYPE),
+            ('ended_at',    Auction.ended_at,       TIME_DTYPE),
+        ]),
+        'snapshots':    (Snapshot.timestamp, [
+            ('id',          Snapshot.id,            'int64'),
+            ('auction_id',  Snapshot.auction,       'int64'),
+            ('realm_id',    Auction.realm_key,      'int32'),
+            ('item_id',     Auction.item_id,        'int32'),
+            ('quantity',    Auction.quantity,       'int32'),
+            ('timestamp',   Snapshot.timestamp,     TIME_DTYPE),
+            ('bid',         Snapshot.bid,           'int64'),
+            ('time_left',   Snapshot.time_left,     'int32'),
+        ]),
+    }
+    META_FN             = 'meta.json'
+
+    def __init__(self, path, chunk_size=100000):
+        if numpy is None:
+            raise RuntimeError('ColumnarArchive requires numpy')
+        self._path = path.rstrip('/')
+        self._chunk_size = chunk_size
+
+    def export(self, table, start, end=None):
+        """(Re)write the monthly partitions of ``table`` from ``start`` to
+        ``end``, by default the month of its newest row.
+        """
+        if end is None:
+            time_field = self.TABLES[table][0]
+            end = time_field.model_class.select(fn.Max(time_field)).scalar(convert=True)
+            if end is None and time_field.model_class is Auction:
+                # every auction has been archived
+                end = (PARTITIONS.months() or [None])[-1]
+            if end is None:
+                logger.info('Nothing to export for %s', table)
+                return
+        for month in _iter_months(start, end):
+            self.export_partition(table, month)
+
+    def export_partition(self, table, month):
+        time_field, columns = self.TABLES[table]
+        month = _get_month(month)
+        where = (time_field >= month) & (time_field < _next_month(month))
+        model = time_field.model_class
+        query = model.select(*[f for _, f, _ in columns]).where(where).order_by(time_field.asc())
+        if model is Snapshot:
+            query = query.join(Auction)
+        else:
+            # archived auctions are only in their partition
+            query = PARTITIONS.select(query, month, month)
+        row_count = query.count()
+        partition = month.strftime('%Y-%m')
+        if not row_count:
+            # e.g. compacted snapshots, an earlier export of them is kept
+            logger.info('No rows for %s partition %s, skipping it', table, partition)
+            return
+        logger.info('Exporting %s partition %s: %d rows', table, partition, row_count)
+
+        table_path = os.path.join(self._path, table)
+        if not os.path.isdir(table_path):
+            os.makedirs(table_path)
+        tmp_path = os.path.join(table_path, '.{}.tmp'.format(partition))
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.mkdir(tmp_path)
+        outputs = [numpy.lib.format.open_memmap(os.path.join(tmp_path, name + '.npy'),
+            mode='w+', dtype=dtype, shape=(row_count,)) for name, _, dtype in columns]
+
+        offset = 0
+        # realm key -> realm_id
+        realm_ids = collections.OrderedDict()
+        for chunk in _chunks_iter(query.tuples().iterator(), self._chunk_size):
+            # rows added since the count are left for the next export
+            chunk = chunk[:row_count - offset]
+            for out, (_, field, dtype), values in itertools.izip(outputs, columns, zip(*chunk)):
+                if field is Auction.realm_key:
+                    out[offset:offset+len(chunk)] = [-1 if v is None else \
+                        realm_ids.setdefault(v, len(realm_ids)) for v in values]
+                elif dtype == self.TIME_DTYPE:
+                    out[offset:offset+len(chunk)] = numpy.array(values, dtype=dtype)
+                else:
+                    out[offset:offset+len(chunk)] = [-1 if v is None else v for v in values]
+            offset += len(chunk)
+        for out in outputs:
+            out.flush()
+        del outputs
+        with open(os.path.join(tmp_path, self.META_FN), 'w') as meta_handle:
+            json.dump({
+                'rows':         offset,
+                'columns':      [(name, dtype) for name, _, dtype in columns],
+                'realm_keys':   list(realm_ids),
+                'exported_at':  datetime.datetime.utcnow().isoformat(),
+            }, meta_handle)
+
+        final_path = os.path.join(table_path, partition)
+        if os.path.exists(final_path):
+            shutil.rmtree(final_path)
+        os.rename(tmp_path, final_path)
+
+    def partitions(self, table, start=None, end=None):
+        """Names of the partitions of ``table`` overlapping ``start`` to ``end``."""
+        table_path = os.path.join(self._path, table)
+        if not os.path.isdir(table_path):
+            return []
+        lo = None if start is None else _get_month(start).strftime('%Y-%m')
+        hi = None if end is None else _get_month(end).strftime('%Y-%m')
+        return sorted(p for p in os.listdir(table_path) \
+            if not p.startswith('.') and (lo is None or p >= lo) and (hi is None or p <= hi))
+
+    def read_partition(self, table, partition, columns=None):
+        """Return ``{column: array}`` with every array memory mapped read-only."""
+        partition_path = os.path.join(self._path, table, partition)
+        meta = self._read_meta(table, partition)
+        names = [name for name, _ in meta['columns']] if columns is None else columns
+        return dict((name, numpy.load(os.path.join(partition_path, name + '.npy'), mmap_mode='r')[:meta['rows']]) \
+            for name in names)
+
+    def get_realm_keys(self, table, partition):
+        """The realm keys of the partition, indexed by its ``realm_id`` column."""
+        # partitions exported before there was a realm_id column have none
+        return self._read_meta(table, partition).get('realm_keys', [])
+
+    def _read_meta(self, table, partition):
+        with open(os.path.join(self._path, table, partition, self.META_FN)) as meta_handle:
+            return json.load(meta_handle)
+
+    def scan(self, table, start=None, end=None, columns=None):
+        """Yield ``(partition, {column: array})`` for each overlapping partition.
+
+        Partitions are whole months, callers narrow them down further with a
+        mask on the time column if needed.
+        """
+        for partition in self.partitions(table, start, end):
+            yield partition, self.read_partition(table, partition, columns)
+
+def _iter_months(start, end):
+    month = _get_month(start)
+    while month <= end:
+        yield month
+        month = _next_month(month)
+
+def _get_month(ts):
+    return datetime.datetime(ts.year, ts.month, 1)
+
+def _next_month(month):
+    return datetime.datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+def _chunks_iter(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+class AuctionIntervalIndex(object):
+    """In-memory index of auction lifetimes for batch sibling lookups.
+
+    The Auction.get_siblings() condition is a pair of range queries, one on
+    each end of the lifetime, so every (realm_key, item_id, has buyout) bucket keeps its
+    auctions sorted by start and by end and a lookup is a few bisections
+    plus the matches. Auctions can be added at any time; buckets are only
+    re-sorted on the next lookup.
+    """
+    def __init__(self, auctions=()):
+        # (realm_key, item_id, has buyout) -> [by start, by end, open, is sorted]
+        self._buckets = {}
+        for a in auctions:
+            self.add(a)
+
+    def add(self, auction):
+        key = (auction.realm_key, auction.item_id, auction.buyout is not None)
+        bucket = self._buckets.setdefault(key, [[], [], [], True])
+        # the IDs are unique, so sorting never compares the auctions
+        bucket[0].append((auction.started_at, auction.id, auction))
+        if auction.ended_at is None:
+            bucket[2].append(auction)
+        else:
+            bucket[1].append((auction.ended_at, auction.id, auction))
+        bucket[3] = False
+
+    def get_siblings(self, auction):
+        """Return the auctions matched by ``auction.get_siblings()``, in the same order."""
+        bucket = self._buckets.get((auction.realm_key, auction.item_id, auction.buyout is not None))
+        if bucket is None:
+            return []
+        by_start, by_end, open_auctions, is_sorted = bucket
+        if not is_sorted:
+            by_start.sort()
+            by_end.sort()
+            bucket[3] = True
+        if auction.ended_at is None:
+            matches = dict((pk, a) for _, pk, a in \
+                by_start[bisect.bisect_left(by_start, (auction.started_at,)):])
+            matches.update((a.id, a) for a in open_auctions)
+        else:
+            lo, hi = (auction.started_at,), (auction.ended_at, float('inf'))
+            matches = dict((pk, a) for _, pk, a in by_start[
+                bisect.bisect_left(by_start, lo):bisect.bisect_right(by_start, hi)])
+            matches.update((pk, a) for _, pk, a in by_end[
+                bisect.bisect_left(by_end, lo):bisect.bisect_right(by_end, hi)])
+        matches.pop(auction.id, None)
+        return sorted(matches.itervalues(), key=lambda a: (a.started_at, a.id))
+
+class ResultEstimator(object):
+    """Batch version of Auction.estimate_result() and estimate_ended_at().
+
+    Every auction that ended within a time window is classified from a few
+    queries loaded into NumPy arrays, instead of several queries per auction
+    (and one more per sibling snapshot). The rules and their quirks, like
+    the integer division in ``bid_ppi`` / ``buyout_ppi``, match the per-row
+    methods exactly.
+    """
+    RESULTS             = ['WON_BUYOUT', 'WON_BID', 'EXPIRED', 'CANCELLED']
+
+    def __init__(self, batch_size=500, max_cells=4 * 1024 * 1024):
+        if numpy is None:
+            raise RuntimeError('ResultEstimator requires numpy')
+        self._batch_size = batch_size
+        # upper bound on the size of the target x sibling matrices
+        self._max_cells = max_cells
+        # realm keys are numbered for the arrays
+        self._realm_ids = {}
+        self._realm_keys = []
+
+    def estimate(self, start, end, force=False, save=True):
+        """Estimate the results of auctions with ``start <= ended_at <= end``.
+
+        Returns a dict of Auction.id -> (est_result, est_ended_at). Auctions
+        with an ``est_result`` already are skipped unless ``force`` is set.
+        """
+        _check_realm_keys(start - MAX_AUCTION_DURATION, end)
+        logger.debug('Loading ended auctions...')
+        where = Auction.ended_at.between(start, end)
+        if not force:
+            where &= Auction.est_result.is_null(True)
+        targets = self._load_auctions(where, start - MAX_AUCTION_DURATION, end)
+        logger.debug('Found ended auctions: %d', len(targets['id']))
+        if not len(targets['id']):
+            return {}
+
+        logger.debug('Loading auction snapshots...')
+        snaps = self._load_snapshot_stats(where, targets['id'])
+        # auctions without any snapshots can not be estimated
+        has_snaps = snaps['count'] > 0
+        targets = dict((k, v[has_snaps]) for k, v in targets.iteritems())
+        snaps = dict((k, v[has_snaps]) for k, v in snaps.iteritems())
+
+        logger.debug('Comparing against sibling auctions...')
+        lowest_buyout = self._was_lowest_buyout(targets)
+        logger.debug('Comparing against sibling snapshots...')
+        lowest_bid = self._was_lowest_bid(targets, snaps)
+
+        time_expired = snaps['last_time_left'] <= Snapshot.TIME_LEFT_ENUM['MEDIUM']
+        had_bids = snaps['first_bid'] != snaps['max_bid']
+        run_time = targets['ended_at'] - targets['started_at']
+        won_bid = had_bids | (lowest_bid & (run_time > Snapshot.TIME_LEFT_ENUM['LONG']))
+        result_idx = numpy.where(time_expired,
+            numpy.where(won_bid, 1, 2),
+            numpy.where(lowest_buyout, 0, 3))
+        ended_at = targets['started_at'] + snaps['first_time_left'] - \
+            snaps['count'] * 60 * 60 + snaps['bid_count'] * 5 * 60
+
+        results = dict((int(pk), (self.RESULTS[r], datetime.datetime.utcfromtimestamp(int(e)))) \
+            for pk, r, e in itertools.izip(targets['id'], result_idx, ended_at))
+        if save:
+            self._save(results)
+            self._update_item_stats(targets, result_idx <= 1)
+        return results
+
+    def _load_auctions(self, where, start, end):
+        """Load the auctions matching ``where``, which started from ``start`` to ``end``."""
+        rows = PARTITIONS.select(Auction.select(
+            Auction.id, Auction.item_id, Auction.quantity, Auction.buyout,
+            Auction.started_at, Auction.ended_at, Auction.est_result, Auction.realm_key
+        ).where(where), start, end).tuples()
+        cols = zip(*rows) or [()] * 8
+        return {
+            'id':           numpy.array(cols[0], dtype=numpy.int64),
+            'realm':        self._get_realm_ids(cols[7]),
+            'item_id':      numpy.array(cols[1], dtype=numpy.int64),
+            'quantity':     numpy.array(cols[2], dtype=numpy.int64),
+            'buyout':       numpy.array([-1 if b is None else b for b in cols[3]], dtype=numpy.int64),
+            'started_at':   _epoch_array(cols[4]),
+            'ended_at':     _epoch_array(cols[5]),
+            'was_won':      numpy.array([r in ('WON_BUYOUT', 'WON_BID') for r in cols[6]], dtype=bool),
+        }
+
+    def _load_snapshot_stats(self, where, auction_ids):
+        """Per auction snapshot aggregates, aligned with ``auction_ids``.
+
+        ``where`` is the condition the auctions were loaded with.
+        """
+        rows = Snapshot.select(
+            Snapshot.auction, Snapshot.id, Snapshot.timestamp,
+            Snapshot.bid, Snapshot.time_left
+        ).join(Auction).where(where).tuples()
+        cols = zip(*rows) or [()] * 5
+        aid = numpy.array(cols[0], dtype=numpy.int64)
+        sid = numpy.array(cols[1], dtype=numpy.int64)
+        ts = _epoch_array(cols[2])
+        bid = numpy.array(cols[3], dtype=numpy.int64)
+        time_left = numpy.array(cols[4], dtype=numpy.int64)
+
+        order = numpy.lexsort((ts, aid))
+        aid, sid, ts, bid, time_left = aid[order], sid[order], ts[order], bid[order], time_left[order]
+        group_aids, first, count = numpy.unique(aid, return_index=True, return_counts=True)
+        last = first + count - 1
+        changed = numpy.zeros(len(bid), dtype=numpy.int64)
+        changed[1:] = (bid[1:] != bid[:-1]) & (aid[1:] == aid[:-1])
+
+        # align to auction_ids, with count == 0 for auctions without snapshots
+        n = len(auction_ids)
+        pos = numpy.searchsorted(group_aids, auction_ids)
+        pos[pos >= len(group_aids)] = 0
+        found = (group_aids[pos] == auction_ids) if len(group_aids) else numpy.zeros(n, dtype=bool)
+        stats = {}
+        for k, values in (
+                ('count',           count),
+                ('first_bid',       bid[first]),
+                ('first_time_left', time_left[first]),
+                ('max_bid',         numpy.maximum.reduceat(bid, first) if len(bid) else bid),
+                ('bid_count',       numpy.add.reduceat(changed, first) if len(bid) else bid),
+                ('last_id',         sid[last]),
+                ('last_ts',         ts[last]),
+                ('last_bid',        bid[last]),
+                ('last_time_left',  time_left[last])):
+            stats[k] = numpy.zeros(n, dtype=numpy.int64)
+            stats[k][found] = values[pos[found]]
+        return stats
+
+    def _get_realm_ids(self, realm_keys):
+        ids = []
+        for realm_key in realm_keys:
+            realm_id = self._realm_ids.get(realm_key)
+            if realm_id is None:
+                realm_id = self._realm_ids[realm_key] = len(self._realm_keys)
+                self._realm_keys.append(realm_key)
+            ids.append(realm_id)
+        return numpy.array(ids, dtype=numpy.int64)
+
+    def _was_lowest_buyout(self, targets):
+        """Whether each target had no cheaper (per realm group and item)
+        overlapping buyout that ended at a different time, see
+        Auction.get_siblings().
+        """
+        result = numpy.zeros(len(targets['id']), dtype=bool)
+        has_buyout = targets['buyout'] >= 0
+        if not has_buyout.any():
+            return result
+        lo = datetime.datetime.utcfromtimestamp(int(targets['started_at'].min()))
+        hi = datetime.datetime.utcfromtimestamp(int(targets['ended_at'].max()))
+        # siblings of a target with a buyout always have one as well
+        siblings = self._load_auctions(Auction.buyout.is_null(False) &
+            (Auction.started_at.between(lo, hi) | Auction.ended_at.between(lo, hi)),
+            lo - MAX_AUCTION_DURATION, hi)
+        sib_ppi = siblings['buyout'] // siblings['quantity']
+        tgt_ppi = targets['buyout'] // targets['quantity']
+
+        n = len(targets['id'])
+        group = _dense_key(
+            numpy.concatenate([targets['realm'], siblings['realm']]),
+            numpy.concatenate([targets['item_id'], siblings['item_id']]))
+        tgt_group, sib_group = group[:n], group[n:]
+        order = numpy.argsort(sib_group, kind='mergesort')
+        sib_groups = sib_group[order]
+        for g in numpy.unique(tgt_group[has_buyout]):
+            t_idx = numpy.flatnonzero(has_buyout & (tgt_group == g))
+            s_idx = order[numpy.searchsorted(sib_groups, g, 'left'):
+                numpy.searchsorted(sib_groups, g, 'right')]
+            if not len(s_idx):
+                result[t_idx] = True
+                continue
+            chunk = max(1, self._max_cells // len(s_idx))
+            for i in range(0, len(t_idx), chunk):
+                t = t_idx[i:i+chunk, numpy.newaxis]
+                t_start, t_end = targets['started_at'][t], targets['ended_at'][t]
+                s_start, s_end = siblings['started_at'][s_idx], siblings['ended_at'][s_idx]
+                # the target itself is never cheaper than itself, so it needs
+                # no special casing
+                cheaper = (
+                    (((s_start >= t_start) & (s_start <= t_end)) |
+                        ((s_end >= t_start) & (s_end <= t_end))) &
+                    (sib_ppi[s_idx] < tgt_ppi[t]) &
+                    (siblings['ended_at'][s_idx] != t_end))
+                result[t_idx[i:i+chunk]] = ~cheaper.any(axis=1)
+        return result
+
+    def _was_lowest_bid(self, targets, snaps):
+        """Whether each target's final snapshot had no cheaper (per realm
+        group and item) snapshot at the same time whose auction ended at a
+        different time, see Snapshot.get_siblings().
+        """
+        rows = []
+        timestamps = [datetime.datetime.utcfromtimestamp(int(t)) for t in numpy.unique(snaps['last_ts'])]
+        for i in range(0, len(timestamps), self._batch_size):
+            rows.extend(Snapshot.select(
+                Snapshot.timestamp, Snapshot.bid, Auction.item_id, Auction.quantity, Auction.ended_at,
+                Auction.realm_key
+            ).join(Auction).where(
+                Snapshot.timestamp << timestamps[i:i+self._batch_size]
+            ).tuples())
+        cols = zip(*rows) or [()] * 6
+        sib_ts = _epoch_array(cols[0])
+        sib_ppi = numpy.array(cols[1], dtype=numpy.int64) // numpy.array(cols[3], dtype=numpy.int64)
+        sib_item = numpy.array(cols[2], dtype=numpy.int64)
+        sib_ended = _epoch_array(cols[4])
+        sib_realm = self._get_realm_ids(cols[5])
+        tgt_ppi = snaps['last_bid'] // targets['quantity']
+
+        n = len(sib_ts)
+        group = _dense_key(
+            numpy.concatenate([sib_realm, targets['realm']]),
+            numpy.concatenate([sib_item, targets['item_id']]),
+            numpy.concatenate([sib_ts, snaps['last_ts']]))
+        ended = numpy.concatenate([sib_ended, targets['ended_at']])
+        group_ended = _dense_key(group, ended)
+        ppi = numpy.concatenate([sib_ppi, tgt_ppi])
+        # cheaper snapshots of the same item at the same time, minus the ones
+        # whose auction ended along with the target
+        cheaper = _count_below(group[:n], ppi[:n], group[n:], ppi[n:]) - \
+            _count_below(group_ended[:n], ppi[:n], group_ended[n:], ppi[n:])
+        return cheaper == 0
+
+    def _save(self, results):
+        db = GlobalMeta.database
+        sql = 'UPDATE {0}{1}{0} SET est_result = {2}, est_ended_at = {2} WHERE id = {2}'.format(
+            db.quote_char, Auction._meta.db_table, db.interpolation)
+        rows = [(r, e, pk) for pk, (r, e) in results.iteritems()]
+        with db.atomic():
+            for i in range(0, len(rows), self._batch_size):
+                db.get_cursor().executemany(sql, rows[i:i+self._batch_size])
+                QUERY_COUNTER.add()
+
+    def _update_item_stats(self, targets, is_won):
+        """Apply the change in WON_* results to ItemStats.won_count."""
+        delta = is_won.astype(numpy.int64) - targets['was_won']
+        changed = delta != 0
+        by_ended_at = collections.defaultdict(lambda: collections.defaultdict(int))
+        for realm, item_id, ended_at, d in itertools.izip(targets['realm'][changed],
+                targets['item_id'][changed], targets['ended_at'][changed], delta[changed]):
+            by_ended_at[(int(realm), int(ended_at))][int(item_id)] += int(d)
+        with GlobalMeta.database.atomic():
+            for (realm, ended_at), won in by_ended_at.iteritems():
+                ItemStats.add_deltas(dict((item_id, {'won_count': d}) for item_id, d in won.iteritems()),
+                    datetime.datetime.utcfromtimestamp(ended_at), self._realm_keys[realm])
+
+def _epoch_array(values):
+    # None (e.g. an open auction's ended_at) becomes -1, which never matches
+    return numpy.array([-1 if v is None else calendar.timegm(v.utctimetuple()) for v in values],
+        dtype=numpy.int64)
+
+def _dense_key(*columns):
+    """Map each row of the given columns to a dense integer ID."""
+    key = numpy.zeros(len(columns[0]), dtype=numpy.int64)
+    for col in columns:
+        _, col_ids = numpy.unique(col, return_inverse=True)
+        _, key = numpy.unique(key * (col_ids.max() + 1 if len(col_ids) else 1) + col_ids,
+            return_inverse=True)
+    return key
 
-            ParsedFile.create(realm_key=data['realm_key'], hash=data['realm_hash'], timestamp=ts)
+def _count_below(keys, values, query_keys, query_values):
+    """For each query, count the rows with the same key and a smaller value."""
+    _, ranks = numpy.unique(numpy.concatenate([values, query_values]), return_inverse=True)
+    n = (ranks.max() + 1) if len(ranks) else 1
+    composite = numpy.sort(keys * n + ranks[:len(values)])
+    return numpy.searchsorted(composite, query_keys * n + ranks[len(values):], 'left') - \
+        numpy.searchsorted(composite, query_keys * n, 'left')
 
 
 if __name__ == '__main__':
@@ -390,13 +3223,79 @@ if __name__ == '__main__':
     parser.add_option('--day-buffer', type='int', default=7)
     parser.add_option('-p', '--progress', action='store_true', default=False)
     parser.add_option('-s', '--skip-before', type='int', default=0)
+    parser.add_option('-S', '--streaming', action='store_true', default=False)
+    parser.add_option('-w', '--workers', type='int', default=0)
+    parser.add_option('--prefetch', type='int', default=None)
+    parser.add_option('--staging', action='store_true', default=False)
+    parser.add_option('--rebuild-stats', action='store_true', default=False)
+    parser.add_option('--normalize-attrs', action='store_true', default=False)
+    parser.add_option('--retention-days', type='int', default=None,
+        help='compact and archive auctions that ended this many days before the last dump')
+    parser.add_option('--metrics-jsonl', default=None,
+        help='append per dump import metrics to this JSON lines file')
+    parser.add_option('--metrics-textfile', default=None,
+        help='keep per dump import metrics in this Prometheus textfile')
+    parser.add_option('--watch', action='store_true', default=False,
+        help='keep running and import new dumps as they arrive')
+    parser.add_option('--poll-interval', type='float', default=1.0,
+        help='seconds between checks for new dumps in --watch mode')
+    parser.add_option('--resume', action='store_true', default=False,
+        help='skip dumps up to the last parsed one of their realm group without looking them up')
+    parser.add_option('-R', '--realm-workers', type='int', default=0,
+        help='import this many realm groups at the same time, one process each')
+    parser.add_option('--assign-realm-keys', action='store_true', default=False,
+        help='set the realm group of auctions imported before it was stored')
 
     opts, args = parser.parse_args()
     data_path, db_url = args
     OPTION_DISABLE_PROGRESS_BAR = not opts.progress
+    if opts.watch and opts.workers:
+        parser.error('--watch reads one dump at a time, --workers can not be used with it')
+    if opts.realm_workers and (opts.watch or opts.workers):
+        parser.error('--realm-workers can not be used with --watch or --workers')
+    if opts.watch and opts.retention_days is not None:
+        parser.error('--watch does not return, run --retention-days separately')
 
     db_connect(db_url)
 
-    ds = DataSource(data_path, opts.skip_before)
-    dm = DataManager()
-    dm.import_data(ds, batch_size=opts.batch_size, day_buffer=opts.day_buffer)
+    if opts.watch:
+        import signal
+        # let the current dump's transaction roll back cleanly on shutdown
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        ds = DataWatcher(data_path, opts.skip_before or None, streaming=opts.streaming,
+            poll_interval=opts.poll_interval)
+    else:
+        ds = DataSource(data_path, opts.skip_before, streaming=opts.streaming,
+            workers=opts.workers, prefetch=opts.prefetch)
+        if opts.resume:
+            ds.resume()
+    sinks = []
+    if opts.metrics_jsonl:
+        sinks.append(JsonLinesSink(opts.metrics_jsonl))
+    if opts.metrics_textfile:
+        sinks.append(PrometheusTextfileSink(opts.metrics_textfile))
+    dm = DataManager(sinks=sinks)
+    if opts.assign_realm_keys:
+        dm.assign_realm_keys()
+    if opts.rebuild_stats:
+        dm.rebuild_item_stats()
+    if opts.normalize_attrs:
+        dm.normalize_item_attributes()
+    failed = []
+    if opts.realm_workers:
+        failed = RealmImporter(db_url, data_path, opts.realm_workers, opts.skip_before,
+            streaming=opts.streaming, resume=opts.resume, sinks=sinks).import_data(
+                batch_size=opts.batch_size, day_buffer=opts.day_buffer, staging=opts.staging)
+        if failed:
+            logger.error('Failed to import realm groups: %s', ', '.join(failed))
+    else:
+        dm.import_data(ds, batch_size=opts.batch_size, day_buffer=opts.day_buffer,
+            staging=opts.staging)
+    if opts.retention_days is not None:
+        last_ts = ParsedFile.select(fn.Max(ParsedFile.timestamp)).scalar(convert=True)
+        if last_ts is not None:
+            cutoff = last_ts - datetime.timedelta(days=opts.retention_days)
+            dm.compact_snapshots(cutoff)
+            PARTITIONS.archive(cutoff)
+    if failed:
+        sys.exit(1)